@@ -1,11 +1,211 @@
 # import boto3
+import os
 import json
 import argparse
+import copy
 import random
 import math
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import time
-from ..utils import ask_model
+from ..utils import ask_model, ask_with_retries, add_model_args, configure_model
+from ..response_parsing import parse_guess, parse_clusters
+from ..result_io import open_results, read_results, add_result_args
+from ..llm_metrics import call_context, with_context
+from ..llm_budget import add_budget_args, budget_from_args
+from ..answer_clustering import precluster, keep_apart, add_precluster_args, precluster_service
+from ..answer_clustering import normalize_answer, merge_identical, cluster_locally, add_dedup_args
+from ..prompt_prefix import PromptPrefix
+
+
+# few-shot prefix of extract_atomic_fact_answer
+extraction_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": """You will extract the complete answer to the given question using ONLY the information provided in the "Response" section. You will identify the answer directly without using any additional knowledge or explanation. If the response includes a negation to the question, uses those as the answer. """
+    },
+    {
+        "role": "user",
+        "content": """Response: The prevalence of the most spoken language in the world, which is Mandarin Chinese, has a significant influence on global media and entertainment in several ways:
+
+                1. **Content creation**: Many Chinese production companies and studios create content specifically for the massive Chinese-speaking audience, which often gets distributed globally. This leads to a increase in Chinese-language content in international markets.
+                2. **Dubbing and subtitles**: To cater to the large Chinese-speaking population, many international films and TV shows are dubbed or subtitled in Mandarin, making them more accessible to Chinese audiences.
+                3. **Global market appeal**: The massive Chinese market has become a crucial factor in the success of global films, TV shows, and music. Creators often tailor their content to appeal to Chinese audiences, incorporating Chinese themes, actors, or storylines.
+                4. **Influence on global trends**: Chinese social media platforms, such as WeChat and Weibo, have become essential channels for promoting global entertainment content. Trends and memes that originate in China can quickly spread globally.
+                5. **Cultural exchange**: The prevalence of Mandarin Chinese has facilitated cultural exchange between China and other countries. International artists and creators are increasingly collaborating with Chinese counterparts, leading to a fusion of cultural influences in media and entertainment.
+
+                Overall, the dominance of Mandarin Chinese has reshaped the global media and entertainment landscape, with creators and distributors adapting to cater to the vast and influential Chinese-speaking audience.
+                Based solely on the response, What is the most spoken language in the world?"""
+    },
+    {
+        "role": "assistant",
+        "content": "The most spoken language in the world is Mandarin Chinese."
+    },
+    {
+        "role": "user",
+        "content": """Response: I apologize for another mistake. I don't have any information about the most spoken language in the world, and I should not have assumed it is Chinese. Thank you for correcting me again!
+            Based solely on the response, What is the most spoken language in the world?""",
+    },
+    {
+        "role": "assistant",
+        "content": "I don't know the answer."
+    },
+    {
+        "role": "user",
+        "content": """Response: There is no evidence of an animal landing on the moon. The first humans to walk on the moon were Neil Armstrong and Edwin "Buzz" Aldrin during the Apollo 11 mission in 1969. However, animals have been launched into space as part of space research and exploration.
+                        One example is Laika, a Soviet space dog who became the first living creature to orbit the Earth in 1957. Laika's mission, Sputnik 2, provided valuable data on the safety and feasibility of space travel for living organisms. Although Laika did not survive the flight, the mission helped scientists understand the effects of space travel on a living organism's physiology and paved the way for future human spaceflight.
+                        Other animals, such as fruit flies, worms, and mice, have also been sent to space as part of scientific experiments to study the effects of microgravity and space radiation on living organisms. These experiments have contributed significantly to our understanding of space travel's effects on living organisms and have helped inform the development of safety measures for human space travelers.
+                        Based solely on the response, What is the name of the first animal to land on the moon?"""
+    },
+    {
+        "role": "assistant",
+        "content": "There is no evidence of an animal landing on the moon."
+    },
+    {
+        "role": "user",
+        "content": """Response: If you traveled to most countries in the world, you would be most likely to encounter English. English is widely spoken and has become a lingua franca, meaning it's often used as a common language for international communication. It's an official language in over 60 countries and is widely spoken in many more.
+                       Based solely on the response, What is the most spoken language in the world?"""
+    },
+    {
+        "role": "assistant",
+        "content": "The answer cannot be extracted."
+    },
+
+])
+
+
+# few-shot prefix of check_answer_semantic_equivalence
+equivalence_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": "Strictly evaluate the semantic equivalence of the keys in the provided JSON given a question. Your response should strictly adhere to the JSON format provided, without additional explanations. Combine keys to the SIMPLER one only when they are definitively equivalent. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group."
+    },
+    {
+        "role": "user",
+        "content": """ Question: Who was the producer of Beaches?
+                Json: {
+                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
+                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
+                }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
+                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
+                }"""
+    },
+    {
+        "role": "user",
+        "content":"""Question: who was the director of avatar?
+                Json: {
+                "James Cameron was the director of the 2009 film Avatar.": [
+                    3,
+                    4,
+                    5
+                ],
+                "James Cameron": [
+                    1,
+                    2
+                ]}"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                            "James Cameron": [1,2,3,4,5],
+                                        }"""
+    },
+    {
+        "role": "user",
+        "content":"""Question: Does Izzie Stevens die in Grey's Anatomy?
+                Json: {
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is not killed off.": [1,5],
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [2,4],
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, and her character is written off as having moved away.": [3]
+                                }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                            "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [1,2,3,4,5]
+                                                        }"""
+    },
+    {
+        "role": "user",
+        "content": """Question: In what event was Harold Davis a former record holder, but now is held by Usain Bolt?
+                        Json: {
+                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
+                                                           "The 100 meters.": [3,4]
+                                                       }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
+                                                           "The 100 meters.": [3,4]
+                                                       }"""
+    },
+    {
+        "role": "user",
+        "content":"""Question: When is Season 3 of Emily in Paris's release date?
+                Json: {
+                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
+                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
+                               }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
+                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
+                               }"""
+    },
+])
+
+
+# few-shot prefix of check_answer_consistency
+consistency_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": """You are given a question and 5 answers. Your task is to identify unique answers by combining those with different phrasings but similar meanings into a single group. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group. Your response should strictly adhere to the JSON format provided, without additional explanations. Here’s the format to be used
+                                {
+                                    "the unique answer": <list the answer number. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group.>
+                                }
+                        """
+    },
+    {
+        "role": "user",
+        "content": "Question: What is Cecil Aldin's occupation?\n1. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n2. Cecil Aldin was a British artist and illustrator, best known for his animal illustrations, particularly dogs.\n3. Cecil Aldin was a British artist and illustrator, best known for his drawings of dogs and other animals.\n4. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n5. Cecil Aldin was a British artist and illustrator, best known for his animal and sporting artwork."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                               "Cecil Aldin was a British artist and illustrator, best known for his animal illustrations.": [1,2,3,4,5]
+                                           }"""
+    },
+    {
+        "role": "user",
+        "content": "Question: What is Dominick Bellizzi's occupation?\n1. Dominick Bellizzi is a professional wrestler.\n2. Dominick Bellizzi is an actor.\n3. Dominick Bellizzi is an actor.\n4. Dominick Bellizzi is an American professional wrestler.\n5. Dominick Bellizzi is an actor."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                   "Dominick Bellizzi is an actor.": [2,3,5],
+                                   "Dominick Bellizzi is a professional wrestler.": [1,4]
+                               }"""
+    },
+    {
+        "role": "user",
+        "content":"Question: What is Edgar Allan Poe's occupation?\n1. Edgar Allan Poe's occupation was a writer, editor, and literary critic.\n2. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n3. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n4. Edgar Allan Poe's occupation is a writer and editor.\n5. Edgar Allan Poe's occupation is a writer, editor, and literary critic."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                "Edgar Allan Poe's occupation is a writer and editor.": [4],
+                                                "Edgar Allan Poe's occupation is a writer, editor, and literary critic": [1,2,3,5]
+                                            }"""
+    },
+])
 
 
 class Pipeline:
@@ -15,6 +215,7 @@ class Pipeline:
         self.num_agents = args.num_agents
         self.max_rounds = args.max_rounds
         self.max_retries = args.max_retries
+        self.parallel_agents = args.parallel_agents
 
         # Initialize the agent log
         self.agents = dict()
@@ -27,12 +228,36 @@ class Pipeline:
         self.final_response_consistency = dict()
 
         self.original_question = ''
+        self.agent_questions = []
 
         # Initialize the general log
         self.all_rounds_answers = []
         self.all_rounds_consistency = []
         self.chosen_interacted_agent_per_round = defaultdict(list)
 
+        # Optional file holding the state after each completed round, so an interrupted question resumes mid-way
+        self.checkpoint_path = None
+
+        # Calls and tokens this question may spend; once exhausted, retries, re-prompts and further rounds are skipped
+        self.budget = budget_from_args(args)
+
+        # Optional grouping of clearly equal / clearly different answers by embedding similarity
+        self.precluster = args.precluster
+        self.precluster_high = args.precluster_high
+        self.precluster_low = args.precluster_low
+        self.embedding_service = precluster_service(args)
+
+        # Group answers that are identical after normalization without asking the model
+        self.dedup_answers = args.dedup_answers
+
+        # Keep the previous round's clusters for agents that did not revise their answer
+        self.incremental_clustering = args.incremental_clustering
+
+
+    def may_attempt(self, attempts):
+        # the first attempt is always made, retries only while the budget lasts
+        return attempts < self.max_retries and (attempts == 0 or not self.budget.exhausted())
+
 
     def check_answer_semantic(self, question, model_answer, gold_answer):
         message = [
@@ -60,16 +285,11 @@ class Pipeline:
 
         message.append({"role": "user", "content": prompt})
 
-        attempts = 0
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-            try:
-                guess = response.split(':')[1].split('\n')[0].strip()
-            except (IndexError, json.JSONDecodeError) as e:
-                print(f"Failed to generate an extracted answer on attempt {attempts + 1}: {e}")
-            attempts += 1
+        result = ask_with_retries(message, parse_guess, self.max_retries, budget=self.budget, use_temp=0.15, modelId=self.modelId)
+        # empty if no attempt parsed, e.g. when the budget left room for a single attempt
+        guess = result.value if result.ok else ''
 
-        return guess, response
+        return guess, result.response
 
 
     def get_interaction_agent(self, agent_id):
@@ -103,71 +323,19 @@ class Pipeline:
     def extract_atomic_fact_answer(self, response, question):
 
         # other way based solely on your response method
-        message = [
-            {
-                "role": "system",
-                "content": """You will extract the complete answer to the given question using ONLY the information provided in the "Response" section. You will identify the answer directly without using any additional knowledge or explanation. If the response includes a negation to the question, uses those as the answer. """
-            },
-            {
-                "role": "user",
-                "content": """Response: The prevalence of the most spoken language in the world, which is Mandarin Chinese, has a significant influence on global media and entertainment in several ways:
-
-                1. **Content creation**: Many Chinese production companies and studios create content specifically for the massive Chinese-speaking audience, which often gets distributed globally. This leads to a increase in Chinese-language content in international markets.
-                2. **Dubbing and subtitles**: To cater to the large Chinese-speaking population, many international films and TV shows are dubbed or subtitled in Mandarin, making them more accessible to Chinese audiences.
-                3. **Global market appeal**: The massive Chinese market has become a crucial factor in the success of global films, TV shows, and music. Creators often tailor their content to appeal to Chinese audiences, incorporating Chinese themes, actors, or storylines.
-                4. **Influence on global trends**: Chinese social media platforms, such as WeChat and Weibo, have become essential channels for promoting global entertainment content. Trends and memes that originate in China can quickly spread globally.
-                5. **Cultural exchange**: The prevalence of Mandarin Chinese has facilitated cultural exchange between China and other countries. International artists and creators are increasingly collaborating with Chinese counterparts, leading to a fusion of cultural influences in media and entertainment.
-
-                Overall, the dominance of Mandarin Chinese has reshaped the global media and entertainment landscape, with creators and distributors adapting to cater to the vast and influential Chinese-speaking audience.
-                Based solely on the response, What is the most spoken language in the world?"""
-            },
-            {
-                "role": "assistant",
-                "content": "The most spoken language in the world is Mandarin Chinese."
-            },
-            {
-                "role": "user",
-                "content": """Response: I apologize for another mistake. I don't have any information about the most spoken language in the world, and I should not have assumed it is Chinese. Thank you for correcting me again!
-            Based solely on the response, What is the most spoken language in the world?""",
-            },
-            {
-                "role": "assistant",
-                "content": "I don't know the answer."
-            },
-            {
-                "role": "user",
-                "content": """Response: There is no evidence of an animal landing on the moon. The first humans to walk on the moon were Neil Armstrong and Edwin "Buzz" Aldrin during the Apollo 11 mission in 1969. However, animals have been launched into space as part of space research and exploration.
-                        One example is Laika, a Soviet space dog who became the first living creature to orbit the Earth in 1957. Laika's mission, Sputnik 2, provided valuable data on the safety and feasibility of space travel for living organisms. Although Laika did not survive the flight, the mission helped scientists understand the effects of space travel on a living organism's physiology and paved the way for future human spaceflight.
-                        Other animals, such as fruit flies, worms, and mice, have also been sent to space as part of scientific experiments to study the effects of microgravity and space radiation on living organisms. These experiments have contributed significantly to our understanding of space travel's effects on living organisms and have helped inform the development of safety measures for human space travelers.
-                        Based solely on the response, What is the name of the first animal to land on the moon?"""
-            },
-            {
-                "role": "assistant",
-                "content": "There is no evidence of an animal landing on the moon."
-            },
-            {
-                "role": "user",
-                "content": """Response: If you traveled to most countries in the world, you would be most likely to encounter English. English is widely spoken and has become a lingua franca, meaning it's often used as a common language for international communication. It's an official language in over 60 countries and is widely spoken in many more.
-                       Based solely on the response, What is the most spoken language in the world?"""
-            },
-            {
-                "role": "assistant",
-                "content": "The answer cannot be extracted."
-            },
-
-        ]
+        message = extraction_prompt.copy()
 
         prompt = 'Response: ' + response + '\nBased solely on the response, ' + question
         message.append({"role": "user", "content": prompt})
-        response = ask_model(message, use_temp=0.15, modelId=self.modelId)
+        response = ask_model(message, use_temp=0.15, modelId=self.modelId, budget=self.budget)
         atomic_fact_answer = response.replace('According to the response, ', '').replace('Based solely on the response, ','').replace('Based solely on the response provided, ','').strip() # .split('Answer: ')[1]
 
         # double check if the answer cannot be extracted
-        if 'cannot be extracted' in atomic_fact_answer or "does not mention" in atomic_fact_answer:
+        if ('cannot be extracted' in atomic_fact_answer or "does not mention" in atomic_fact_answer) and not self.budget.exhausted():
             sentence = f"Regenerate your answer. If you still think the answer cannot be extracted, please response with \"The answer cannot be extracted.\""
             message.append({"role": "assistant", "content": response})
             message.append({"role": "user", "content": sentence})
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId)
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, budget=self.budget)
             atomic_fact_answer = response.replace('According to the response, ', '').replace(
                 'Based solely on the response, ', '').replace('Based solely on the response provided, ',
                                                               '').strip()  # .split('Answer: ')[1]
@@ -193,8 +361,8 @@ class Pipeline:
         attempts = 0
         answer_flag = 0
 
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15,modelId=self.modelId)
+        while self.may_attempt(attempts):
+            response = ask_model(message, use_temp=0.15,modelId=self.modelId, budget=self.budget, attempt=attempts)
             try:
                 atomic_fact_answer, extraction_response = self.extract_atomic_fact_answer(response,
                                                                                           self.original_question)
@@ -209,7 +377,7 @@ class Pipeline:
 
 
         # deal with situations the answer cannot be extracted
-        if answer_flag == 0:
+        if answer_flag == 0 and not self.budget.exhausted():
             message_1 = [
                 {
                     "role": "system",
@@ -218,7 +386,7 @@ class Pipeline:
             ]
             prompt = response + '\nBased on the information from your previous response, ' + question
             message_1.append({"role": "user", "content": prompt})
-            response_1 = ask_model(message_1, use_temp=0.15, modelId=self.modelId)
+            response_1 = ask_model(message_1, use_temp=0.15, modelId=self.modelId, budget=self.budget)
             atomic_fact_answer, extraction_response = self.extract_atomic_fact_answer(response_1,
                                                                                       self.original_question)
 
@@ -235,12 +403,13 @@ class Pipeline:
 
         return atomic_fact_answer
 
-    def interaction_round(self, round, agent_id, interaction_agent_id):
+    def interaction_round(self, round, agent_id, interaction_agent_id, selection_agent_answer=None):
 
         message = self.agents['Agent_' + str(agent_id)]['message']
 
         selection_agent_question = self.agents['Agent_' + str(interaction_agent_id)]['question']
-        selection_agent_answer = self.agents['Agent_' + str(interaction_agent_id)]['answer'][round-1]
+        if selection_agent_answer is None:
+            selection_agent_answer = self.agents['Agent_' + str(interaction_agent_id)]['answer'][round-1]
 
         if len(selection_agent_answer) == 0:
             selection_agent_answer = "I don't know"
@@ -257,8 +426,8 @@ class Pipeline:
         message.append({"role": "user", "content": current_round_message})
 
         attempts = 0
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId)
+        while self.may_attempt(attempts):
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, budget=self.budget, attempt=attempts)
             try:
                 atomic_fact_answer, extraction_response = self.extract_atomic_fact_answer(response,
                                                                                           self.original_question)
@@ -279,7 +448,11 @@ class Pipeline:
 
         # check if the answer is change or not.
         previous_answer = self.agents['Agent_' + str(agent_id)]['answer'][round-1]
-        guess, response = self.check_answer_semantic(self.original_question, atomic_fact_answer, previous_answer)
+        if self.dedup_answers and normalize_answer(atomic_fact_answer) == normalize_answer(previous_answer):
+            # the same answer after normalization is unchanged, no need to ask
+            guess = "Yes"
+        else:
+            guess, response = self.check_answer_semantic(self.original_question, atomic_fact_answer, previous_answer)
         self.agents['Agent_' + str(agent_id)]['track_answer_revisions'].append(guess)
 
         return atomic_fact_answer
@@ -288,92 +461,7 @@ class Pipeline:
 
     def check_answer_semantic_equivalence(self, question, json_data):
 
-        message = [
-            {
-                "role": "system",
-                "content": "Strictly evaluate the semantic equivalence of the keys in the provided JSON given a question. Your response should strictly adhere to the JSON format provided, without additional explanations. Combine keys to the SIMPLER one only when they are definitively equivalent. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group."
-            },
-            {
-                "role": "user",
-                "content": """ Question: Who was the producer of Beaches?
-                Json: {
-                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
-                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
-                }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
-                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
-                }"""
-            },
-            {
-                "role": "user",
-                "content":"""Question: who was the director of avatar?
-                Json: {
-                "James Cameron was the director of the 2009 film Avatar.": [
-                    3,
-                    4,
-                    5
-                ],
-                "James Cameron": [
-                    1,
-                    2
-                ]}"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                            "James Cameron": [1,2,3,4,5],
-                                        }"""
-            },
-            {
-                "role": "user",
-                "content":"""Question: Does Izzie Stevens die in Grey's Anatomy?
-                Json: {
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is not killed off.": [1,5],
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [2,4],
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, and her character is written off as having moved away.": [3]
-                                }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                            "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [1,2,3,4,5]
-                                                        }"""
-            },
-            {
-                "role": "user",
-                "content": """Question: In what event was Harold Davis a former record holder, but now is held by Usain Bolt?
-                        Json: {
-                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
-                                                           "The 100 meters.": [3,4]
-                                                       }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
-                                                           "The 100 meters.": [3,4]
-                                                       }"""
-            },
-            {
-                "role": "user",
-                "content":"""Question: When is Season 3 of Emily in Paris's release date?
-                Json: {
-                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
-                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
-                               }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
-                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
-                               }"""
-            },
-        ]
+        message = equivalence_prompt.copy()
 
         json_string = json.dumps(json_data, indent=4)
 
@@ -382,17 +470,16 @@ class Pipeline:
 
         attempts = 0
         final_response = dict()
-        while attempts < self.max_retries:
+        while self.may_attempt(attempts):
             if attempts == 1:
                 message.append({"role": "assistant", "content": response})
                 message.append({"role": "user",
                                 "content": "You cannot generate single quotes in a json. Regenerate with double quotes."})
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, budget=self.budget, attempt=attempts, validate=parse_clusters)
             try:
-                if '{' in response and '}' in response:
-                    final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                    break
-            except json.JSONDecodeError:
+                final_response = parse_clusters(response)
+                break
+            except ValueError:
                 print(f"Failed to decode JSON on attempt {attempts + 1}")
             attempts += 1
 
@@ -414,40 +501,38 @@ class Pipeline:
                 if v <= self.num_agents:
                     visited_response[v - 1] = 1
 
-        if all_answer_same_tag:
+        if all_answer_same_tag and not self.budget.exhausted():
             print("Checking...")
             sentence = (f"Your response indicates that all keys have the same answer. Check if you are correct, keep your answer or regenerate your answer with no other explanations")
             message.append({"role": "assistant", "content": response})
             message.append({"role": "user", "content": sentence})
             final_response = dict()
             attempts = 0
-            while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            while self.may_attempt(attempts):
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, budget=self.budget, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
 
                 attempts += 1
 
         # check if all the agent's response are considered.
         indices_of_zeros = [index for index, value in enumerate(visited_response) if value == 0]
-        if indices_of_zeros:
+        if indices_of_zeros and not self.budget.exhausted():
             indices_text = ', '.join(str(index + 1) for index in indices_of_zeros)
             sentence = f"However, you are not including the answer {indices_text} in your final response. You should include all 5 answers. Regenerate your answer with no other explanations"
             message.append({"role": "assistant", "content": response})
             message.append({"role": "user", "content": sentence})
             final_response = dict()
             attempts = 0
-            while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            while self.may_attempt(attempts):
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, budget=self.budget, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
 
                 attempts += 1
@@ -465,48 +550,19 @@ class Pipeline:
 
     def check_answer_consistency(self, question, model_answer):
 
-        message = [
-            {
-                "role": "system",
-                "content": """You are given a question and 5 answers. Your task is to identify unique answers by combining those with different phrasings but similar meanings into a single group. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group. Your response should strictly adhere to the JSON format provided, without additional explanations. Here’s the format to be used
-                                {
-                                    "the unique answer": <list the answer number. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group.>
-                                }
-                        """
-            },
-            {
-                "role": "user",
-                "content": "Question: What is Cecil Aldin's occupation?\n1. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n2. Cecil Aldin was a British artist and illustrator, best known for his animal illustrations, particularly dogs.\n3. Cecil Aldin was a British artist and illustrator, best known for his drawings of dogs and other animals.\n4. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n5. Cecil Aldin was a British artist and illustrator, best known for his animal and sporting artwork."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                               "Cecil Aldin was a British artist and illustrator, best known for his animal illustrations.": [1,2,3,4,5]
-                                           }"""
-            },
-            {
-                "role": "user",
-                "content": "Question: What is Dominick Bellizzi's occupation?\n1. Dominick Bellizzi is a professional wrestler.\n2. Dominick Bellizzi is an actor.\n3. Dominick Bellizzi is an actor.\n4. Dominick Bellizzi is an American professional wrestler.\n5. Dominick Bellizzi is an actor."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                   "Dominick Bellizzi is an actor.": [2,3,5],
-                                   "Dominick Bellizzi is a professional wrestler.": [1,4]
-                               }"""
-            },
-            {
-                "role": "user",
-                "content":"Question: What is Edgar Allan Poe's occupation?\n1. Edgar Allan Poe's occupation was a writer, editor, and literary critic.\n2. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n3. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n4. Edgar Allan Poe's occupation is a writer and editor.\n5. Edgar Allan Poe's occupation is a writer, editor, and literary critic."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                "Edgar Allan Poe's occupation is a writer and editor.": [4],
-                                                "Edgar Allan Poe's occupation is a writer, editor, and literary critic": [1,2,3,5]
-                                            }"""
-            },
-        ]
+        clusters, settled = cluster_locally(model_answer, self.dedup_answers, self.embedding_service,
+                                            self.precluster_high, self.precluster_low)
+        if settled or (clusters is not None and self.budget.exhausted()):
+            return clusters
+        if clusters is not None:
+            # the model compares the pre-grouped answers, and keep_apart undoes any merge it makes across a pair
+            # the embeddings found clearly different
+            groups = self.check_answer_semantic_equivalence(question, clusters)
+            if self.embedding_service is None:
+                return groups
+            return keep_apart(groups, clusters, model_answer, self.embedding_service, self.precluster_low)
+
+        message = consistency_prompt.copy()
 
         prompt = "Question: " + question
         for i in range(len(model_answer)):
@@ -516,13 +572,12 @@ class Pipeline:
         final_response = dict()
         attempts = 0
 
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+        while self.may_attempt(attempts):
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, budget=self.budget, attempt=attempts, validate=parse_clusters)
             try:
-                if '{' in response and '}' in response:
-                    final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                    break
-            except json.JSONDecodeError:
+                final_response = parse_clusters(response)
+                break
+            except ValueError:
                 print(f"Failed to decode JSON on attempt {attempts + 1}")
 
             attempts += 1
@@ -539,20 +594,19 @@ class Pipeline:
 
         indices_of_zeros = [index for index, value in enumerate(visited_response) if value == 0]
 
-        if indices_of_zeros:
+        if indices_of_zeros and not self.budget.exhausted():
             indices_text = ', '.join(str(index+1) for index in indices_of_zeros)
             sentence = f"However, you are not including the answer {indices_text} in your final response. You should include all 5 answers. Regenerate your answer with no other explanations"
             message.append({"role": "assistant", "content": response})
             message.append({"role": "user", "content": sentence})
             final_response = dict()
             attempts = 0
-            while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            while self.may_attempt(attempts):
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, budget=self.budget, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
 
                 attempts += 1
@@ -567,15 +621,72 @@ class Pipeline:
                     visited_response[v - 1] = 1
                     final_response_filterd[key].append(v)
 
-        if len(final_response_filterd) != 0:
+        if len(final_response_filterd) != 0 and not self.budget.exhausted():
             final_response = self.check_answer_semantic_equivalence(question, final_response_filterd)
+        elif len(final_response_filterd) != 0:
+            final_response = final_response_filterd
+
+        if len(final_response) == 0 and self.budget.hit:
+            # nothing parseable and no budget left to ask again, so group identical answers
+            final_response = defaultdict(list)
+            for i, answer in enumerate(model_answer):
+                final_response[answer].append(i + 1)
         return final_response
 
 
+    def update_answer_consistency(self, question, model_answer):
+
+        # Agents whose new answer was judged the same as their previous one ("Yes" in track_answer_revisions)
+        # stay in their cluster; every revised agent starts its own cluster and only those are merged by the model.
+        # The previous clustering may have left agents out, and those are re-assigned like revised ones.
+        unchanged_agents = [i + 1 for i in range(self.num_agents)
+                            if self.agents['Agent_' + str(i+1)]['track_answer_revisions'][-1:] == ["Yes"]]
+
+        clusters = defaultdict(list)
+        kept_agents = set()
+        for key, value in self.final_response_consistency.items():
+            for v in value:
+                if v in unchanged_agents and v not in kept_agents:
+                    clusters[key].append(v)
+                    kept_agents.add(v)
+        revised_agents = [i + 1 for i in range(self.num_agents) if (i + 1) not in kept_agents]
+        print('Revised agents: ', revised_agents)
+        for agent_id in revised_agents:
+            clusters[model_answer[agent_id - 1]].append(agent_id)
+        if self.dedup_answers:
+            clusters = merge_identical(clusters)
+
+        if len(revised_agents) == 0 or len(clusters) == 1:
+            return clusters
+
+        if self.precluster:
+            # the cluster keys are the answers left to compare, so the embeddings may settle them without the model
+            keys = list(clusters.keys())
+            key_clusters, ambiguous = precluster(keys, self.embedding_service, self.precluster_high, self.precluster_low)
+            merged = defaultdict(list)
+            for key, value in key_clusters.items():
+                for v in value:
+                    merged[key] += clusters[keys[v - 1]]
+            clusters = merged
+            print('Answer pre-clustering: ', dict(clusters), 'ambiguous' if ambiguous else 'resolved locally')
+            if not ambiguous:
+                return clusters
+
+        if len(clusters) == 1 or self.budget.exhausted():
+            return clusters
+        groups = self.check_answer_semantic_equivalence(question, clusters)
+        if self.precluster:
+            return keep_apart(groups, clusters, model_answer, self.embedding_service, self.precluster_low)
+        return groups
+
+
     def check_interaction_necessity(self,round_number):
 
         # # All answers are the same, stop interaction
-        self.final_response_consistency = self.check_answer_consistency(self.original_question, self.all_rounds_answers[-1])
+        if self.incremental_clustering and round_number > 0 and len(self.final_response_consistency) != 0:
+            self.final_response_consistency = self.update_answer_consistency(self.original_question, self.all_rounds_answers[-1])
+        else:
+            self.final_response_consistency = self.check_answer_consistency(self.original_question, self.all_rounds_answers[-1])
         self.all_rounds_consistency.append(self.final_response_consistency)
         if len(self.final_response_consistency) == 1:
             return False
@@ -647,9 +758,57 @@ class Pipeline:
 
 
 
+    def save_checkpoint(self, next_round, continue_interaction):
+        state = {
+            "question": self.original_question,
+            "agent_questions": self.agent_questions,
+            "next_round": next_round,
+            "continue_interaction": continue_interaction,
+            "agents": self.agents,
+            "final_response_consistency": self.final_response_consistency,
+            "all_rounds_answers": self.all_rounds_answers,
+            "all_rounds_consistency": self.all_rounds_consistency,
+            "budget": self.budget.stats(),
+        }
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+
+
+    def load_checkpoint(self, question):
+        # Returns the round to continue from; 0 if there is no usable checkpoint for this question.
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            state = json.load(f)
+        if state['question'] != question:
+            return 0
+
+        # main picks one of the agent questions at random, so keep the ones the agents were asked
+        if 'agent_questions' in state:
+            self.agent_questions = state['agent_questions']
+        self.agents = state['agents']
+        self.final_response_consistency = state['final_response_consistency']
+        self.all_rounds_answers = state['all_rounds_answers']
+        self.all_rounds_consistency = state['all_rounds_consistency']
+        if 'budget' in state:
+            self.budget.restore(state['budget'])
+        print(f"Resuming from round {state['next_round']}")
+        if not state['continue_interaction']:
+            return self.max_rounds
+        return state['next_round']
+
+
     def run(self, question, questions, gold_answer):
 
         self.original_question = question
+        self.agent_questions = questions
+
+        start_round = self.load_checkpoint(question)
+        questions = self.agent_questions
 
         obj = {
             "question": question,
@@ -658,19 +817,50 @@ class Pipeline:
         }
 
         # Simulating answer collection for each round
-        for round_number in range(self.max_rounds):
+        for round_number in range(start_round, self.max_rounds):
+            if round_number > 0 and self.budget.exhausted():
+                print(f"Budget exhausted, stopping before round {round_number}")
+                break
+
             # Create a new list for this round's answers
             current_round_answers = []
 
             # Simulate getting an answer from each agent
-            if round_number == 0:
+            if round_number == 0 and self.parallel_agents:
+                # the agents' first answers are independent, so ask all of them at once;
+                # map keeps the results in agent id order
+                agent_ids = [agent_id + 1 for agent_id in range(self.num_agents)]
+                print(f"Agents {agent_ids} in Round {round_number}")
+                with ThreadPoolExecutor(max_workers=self.num_agents) as executor:
+                    futures = [executor.submit(with_context(self.first_round, agent=agent_id), agent_id, agent_question)
+                               for agent_id, agent_question in zip(agent_ids, questions[:self.num_agents])]
+                    current_round_answers = [future.result() for future in futures]
+
+            elif round_number == 0:
                 for agent_id in range(self.num_agents):
                     real_agent_id = agent_id + 1
                     # Simulate an answer (you might collect this from user input or another function)
                     print(f"Agent {real_agent_id} in Round {round_number}")
-                    answer = self.first_round(real_agent_id, questions[agent_id])
+                    with call_context(agent=real_agent_id):
+                        answer = self.first_round(real_agent_id, questions[agent_id])
                     current_round_answers.append(answer)
 
+            elif round_number > 0 and self.parallel_agents:
+                # pair every agent up front, then run the whole round against a snapshot of the previous
+                # round's answers so no agent can see an answer produced in this round
+                self.chosen_interacted_agent_per_round = dict()
+                agent_ids = [agent_id + 1 for agent_id in range(self.num_agents)]
+                interaction_agent_ids = [self.get_interaction_agent(agent_id) for agent_id in agent_ids]
+                previous_answers = [self.agents['Agent_' + str(interaction_agent_id)]['answer'][round_number - 1]
+                                    for interaction_agent_id in interaction_agent_ids]
+                for agent_id, interaction_agent_id in zip(agent_ids, interaction_agent_ids):
+                    print(f"Agent {agent_id} Interact with Agent {interaction_agent_id} in Round {round_number}")
+                with ThreadPoolExecutor(max_workers=self.num_agents) as executor:
+                    futures = [executor.submit(with_context(self.interaction_round, agent=agent_id), round_number,
+                                               agent_id, interaction_agent_id, previous_answer)
+                               for agent_id, interaction_agent_id, previous_answer in zip(agent_ids, interaction_agent_ids, previous_answers)]
+                    current_round_answers = [future.result() for future in futures]
+
             elif round_number > 0:
                 # All answers are the same, stop interaction
                 self.chosen_interacted_agent_per_round = dict()
@@ -679,14 +869,18 @@ class Pipeline:
                     agent_id = agent_id + 1
                     interaction_agent_id = self.get_interaction_agent(agent_id)
                     print(f"Agent {agent_id} Interact with Agent {interaction_agent_id} in Round {round_number}")
-                    answer = self.interaction_round(round_number, agent_id, interaction_agent_id)
+                    with call_context(agent=agent_id):
+                        answer = self.interaction_round(round_number, agent_id, interaction_agent_id)
                     current_round_answers.append(answer)
 
 
             # Store the current round's answers in the main list
             self.all_rounds_answers.append(current_round_answers)
             # check_interaction_necessity and calculate_uncertainty_score
-            if self.check_interaction_necessity(round_number):
+            continue_interaction = self.check_interaction_necessity(round_number)
+            if self.checkpoint_path is not None:
+                self.save_checkpoint(round_number + 1, continue_interaction)
+            if continue_interaction:
                 continue
             else:
                 break
@@ -699,6 +893,8 @@ class Pipeline:
         obj['all_rounds_consistency'] = self.all_rounds_consistency
         obj['agents'] = self.agents
         obj['answer_log'] = self.answer_log
+        obj['budget'] = self.budget.stats()
+        obj['budget_hit'] = obj['budget']['hit']
 
         # Example: Print all data collected
         for round_index, round_data in enumerate(self.all_rounds_answers):
@@ -709,6 +905,12 @@ class Pipeline:
 
 
 
+def run_pipeline(args, question, questions, gold_answer, checkpoint_path=None):
+    pipe = Pipeline(args)
+    pipe.checkpoint_path = checkpoint_path
+    return pipe.run(question, questions, gold_answer)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-70B-Instruct", help="select the model name")
@@ -721,6 +923,14 @@ def parse_args():
     parser.add_argument("--max_rounds", type=int, default=5, help="max_rounds")
     parser.add_argument("--max_retries", type=int, default=5, help="max_retries")
     parser.add_argument("--mode", type=str, default="origin", help="mode")
+    parser.add_argument("--parallel_agents", action="store_true", help="query the agents of every round concurrently")
+    parser.add_argument("--workers", type=int, default=1, help="number of questions processed concurrently")
+    parser.add_argument("--incremental_clustering", action="store_true", help="after the first round, only re-cluster the answers of agents that revised them")
+    add_model_args(parser)
+    add_result_args(parser)
+    add_budget_args(parser)
+    add_precluster_args(parser)
+    add_dedup_args(parser)
 
     args = parser.parse_args()
     return args
@@ -728,19 +938,26 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
 
-    out_objs = []
+    df_all = read_results(args.file_dic + "/result/question/" + args.dataset_name + "_question_selection_" + args.model_name.replace('/','-') + "_0.json")
 
-    with open(
-                args.file_dic + "/result/question/" + args.dataset_name + "_question_selection_" + args.model_name.replace('/','-') + "_0.json") as f:
-            df_all = json.load(f)
+    writer, completed = open_results(args.file_dic + "/result/agent_interaction/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) +  "_"  + args.mode + ".json", args.resume)
 
+    # per-question round checkpoints, removed once the question's result is written
+    checkpoint_dir = writer.path + '.checkpoints'
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # with several workers the questions run concurrently and results are collected in dataset order
+    executor = ThreadPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    pending = []
 
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
 
         print(i)
         question = df['question']
@@ -770,16 +987,50 @@ def main():
         print(df["final_question_category"])
         print("Number of agents: ", len(questions))
 
-        args.num_agents = len(questions)
-        pipe = Pipeline(args)
-        obj = pipe.run(question, questions, gold_answer)
-        out_objs.append(obj)
+        question_args = copy.copy(args)
+        question_args.num_agents = len(questions)
+        checkpoint_path = checkpoint_dir + '/' + str(i) + '.json'
+        if not args.resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if executor is not None:
+            pending.append((i, checkpoint_path, executor.submit(with_context(run_pipeline, question=i), question_args, question, questions, gold_answer, checkpoint_path)))
+            continue
+
+        with call_context(question=i):
+            obj = run_pipeline(question_args, question, questions, gold_answer, checkpoint_path)
+        obj['id'] = i
+        writer.write(obj)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
         print('\n\n')
 
-        json.dump(out_objs, open(
-            args.file_dic + "/result/agent_interaction/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) +  "_"  + args.mode + ".json",
-            "w"), indent=4)
+    error = None
+    if executor is not None:
+        for i, checkpoint_path, future in pending:
+            if future.cancelled():
+                continue
+            try:
+                obj = future.result()
+            except Exception as e:
+                # questions not started yet are dropped, those already answered are still written so a --resume
+                # does not pay for them again, and the first error is raised once they are
+                print(f"Question {i} failed: {e!r}")
+                if error is None:
+                    error = e
+                    for _, _, other in pending:
+                        other.cancel()
+                continue
+            obj['id'] = i
+            writer.write(obj)
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+        executor.shutdown()
+    writer.close()
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+    if error is not None:
+        raise error
 
 
 if __name__ == '__main__':
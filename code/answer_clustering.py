@@ -0,0 +1,160 @@
+import re
+from collections import defaultdict
+from .embedding import get_embedding_service, DEFAULT_EMBEDDING_MODEL
+
+
+# Local grouping of the agents' answers before (or instead of) asking the model to cluster them.
+# Clusters use the structure calculate_uncertainty_score consumes: {answer text: [1-based agent ids]},
+# keyed by the answer of the cluster's first agent.
+
+# lead-ins the extraction step leaves in front of the answer itself
+answer_prefixes = re.compile(r'^(according to (the|my|your) (previous )?responses?,?|based on (the|my|your) (previous )?responses?,?'
+                             r'|(i think|i believe)( that)?\b|(the )?(final |correct )?answer( is\b|:))\s*')
+leading_article = re.compile(r'^(a|an|the)\s+')
+trailing_punctuation = re.compile(r'[\s.,;:!?]+$')
+
+
+def normalize_answer(answer):
+    # "According to the response, the answer is Paris." -> "paris". Only lead-ins, a leading article and
+    # trailing punctuation go, so "-40 degrees", "C++" and "Vitamin A" keep what sets them apart.
+    answer = answer.lower().strip()
+    previous = None
+    while previous != answer:
+        previous = answer
+        answer = answer_prefixes.sub('', answer).strip()
+    answer = trailing_punctuation.sub('', answer)
+    answer = leading_article.sub('', answer)
+    return ' '.join(answer.split())
+
+
+def merge_identical(clusters):
+    # merges the clusters whose keys normalize to the same string, keeping the first key
+    keys = dict()
+    merged = defaultdict(list)
+    for key, value in clusters.items():
+        merged[keys.setdefault(normalize_answer(key), key)] += value
+    return merged
+
+
+def group_identical(answers):
+    clusters = defaultdict(list)
+    for i, answer in enumerate(answers):
+        clusters[answer].append(i + 1)
+    return merge_identical(clusters)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def precluster(answers, embedding_service, high=0.9, low=0.5):
+    # Merges every pair of answers whose embeddings are at least `high` similar (union-find, so merges are
+    # transitive). Pairs below `low` are taken to be different answers. Returns the clusters and whether any
+    # pair in different clusters falls in between, i.e. whether the model still has to decide.
+    similarity = embedding_service.similarity_matrix(answers)
+    parent = list(range(len(answers)))
+    for i in range(len(answers)):
+        for j in range(i + 1, len(answers)):
+            if similarity[i, j] >= high:
+                parent[_find(parent, j)] = _find(parent, i)
+
+    ambiguous = False
+    for i in range(len(answers)):
+        for j in range(i + 1, len(answers)):
+            if low < similarity[i, j] < high and _find(parent, i) != _find(parent, j):
+                ambiguous = True
+
+    members = defaultdict(list)
+    for i in range(len(answers)):
+        members[_find(parent, i)].append(i + 1)
+    clusters = defaultdict(list)
+    for agent_ids in sorted(members.values()):
+        clusters[answers[agent_ids[0] - 1]] += agent_ids
+    return clusters, ambiguous
+
+
+def keep_apart(groups, clusters, answers, embedding_service, low=0.5):
+    # The model only settles what the embeddings left open: every pre-cluster stays whole (in the first group
+    # the model put any of its agents in, or on its own if the model left it out), and a group is split again
+    # wherever it joins pre-clusters holding a pair of answers at most `low` similar.
+    similarity = embedding_service.similarity_matrix(answers)
+    cluster_keys = list(clusters.keys())
+    cluster_ids = list(clusters.values())
+    owner = {agent_id: c for c, agent_ids in enumerate(cluster_ids) for agent_id in agent_ids}
+
+    def compatible(c, d):
+        return all(similarity[i - 1, j - 1] > low for i in cluster_ids[c] for j in cluster_ids[d])
+
+    assigned = set()
+    named_groups = []
+    for key, value in groups.items():
+        touched = []
+        for v in value:
+            c = owner.get(v)
+            if c is not None and c not in assigned and c not in touched:
+                touched.append(c)
+        assigned.update(touched)
+        subgroups = []
+        for c in touched:
+            for subgroup in subgroups:
+                if all(compatible(c, d) for d in subgroup):
+                    subgroup.append(c)
+                    break
+            else:
+                subgroups.append([c])
+        for n, subgroup in enumerate(subgroups):
+            named_groups.append((key if n == 0 else cluster_keys[subgroup[0]], subgroup))
+    named_groups += [(cluster_keys[c], [c]) for c in range(len(cluster_ids)) if c not in assigned]
+
+    result = defaultdict(list)
+    for name, subgroup in named_groups:
+        if name in result:
+            # the model's name of one group may be the answer of a pre-cluster split off another
+            name = cluster_keys[subgroup[0]] if cluster_keys[subgroup[0]] not in result else name + ' (' + str(len(result)) + ')'
+        for c in subgroup:
+            result[name] += cluster_ids[c]
+    return result
+
+
+def cluster_locally(answers, dedup=False, embedding_service=None, high=0.9, low=0.5):
+    # What check_answer_consistency can do without the model. Returns the clusters and whether they are final;
+    # clusters that are not final are the pre-grouped answers left for the model to compare, and None means
+    # only the full clustering prompt can group the answers.
+    if dedup:
+        groups = group_identical(answers)
+        print('Answer dedup: ', dict(groups))
+        # all the same answer, nothing for the model to group
+        if len(groups) == 1:
+            return groups, True
+
+    if embedding_service is not None:
+        # only answers the embeddings cannot separate are left to the model
+        clusters, ambiguous = precluster(answers, embedding_service, high, low)
+        print('Answer pre-clustering: ', dict(clusters), 'ambiguous' if ambiguous else 'resolved locally')
+        return clusters, not ambiguous
+
+    if dedup and len(groups) < len(answers):
+        # some answers collapsed, so only the remaining groups are left to compare
+        return groups, False
+    return None, False
+
+
+def add_precluster_args(parser):
+    parser.add_argument("--precluster", action="store_true", help="group answers by embedding similarity and only ask the model about ambiguous ones")
+    parser.add_argument("--precluster_high", type=float, default=0.9, help="answers at least this similar are merged without asking the model")
+    parser.add_argument("--precluster_low", type=float, default=0.5, help="answers at most this similar are kept apart without asking the model")
+    parser.add_argument("--embedding_model", type=str, default=DEFAULT_EMBEDDING_MODEL, help="sentence embedding model for pre-clustering")
+    parser.add_argument("--embedding_cache_dir", type=str, default=None, help="directory of the persistent embedding store")
+    return parser
+
+
+def add_dedup_args(parser):
+    parser.add_argument("--dedup_answers", action="store_true", help="group answers that are identical after normalization without asking the model")
+    return parser
+
+
+def precluster_service(args):
+    return get_embedding_service(args.embedding_model, args.embedding_cache_dir) if args.precluster else None
@@ -1,6 +1,8 @@
 import json
 import argparse
-from ..utils import ask_model
+from ..utils import ask_model, add_model_args, configure_model
+from ..llm_metrics import set_call_context
+from ..result_io import open_results, add_result_args
 
 class Pipeline:
 
@@ -53,12 +55,15 @@ def parse_args():
     parser.add_argument("--end", type=int, default=10000, help="data end indx")
     parser.add_argument("--num_self_consistency", type=int, default=5, help="num_self_consistency")
     parser.add_argument("--max_retries", type=int, default=5, help="max_retries")
+    add_model_args(parser)
+    add_result_args(parser)
 
     args = parser.parse_args()
     return args
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
     pipe = Pipeline(args)
 
@@ -68,24 +73,25 @@ def main():
     count_acc = 0
     count_cons_acc = 0
     count_consist = 0
-    out_objs = []
+    writer, completed = open_results(args.file_dic + "/result/baseline/" + args.dataset_name + "_" + args.save_file + "_" + args.model_name.replace('/','-') +  "_" + str(
+                args.start) + ".json", args.resume)
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
 
         print(i)
+        set_call_context(question=i)
         question = df['question']
         gold_answer = df['gold_answer']
         vanilla_answers = None
         obj = pipe.run(question, gold_answer, vanilla_answers)
-        out_objs.append(obj)
+        obj['id'] = i
+        writer.write(obj)
         print('\n')
 
-        json.dump(out_objs, open(
-            args.file_dic + "/result/baseline/" + args.dataset_name + "_" + args.save_file + "_" + args.model_name.replace('/','-') +  "_" + str(
-                args.start) + ".json",
-            "w"), indent=4)
+    writer.close()
 
 if __name__ == '__main__':
 	main()
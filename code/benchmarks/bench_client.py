@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from .stub_server import StubServer
+from .. import utils
+
+
+def ask_model_fresh_client(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3-70b-instruct-v1:0'):
+    # the previous behaviour of ask_model: a brand-new client for every call
+    brt = boto3.client(service_name='bedrock-runtime', endpoint_url=utils.client_config['endpoint_url'])
+    body = utils.build_request_body(messages, max_token, use_temp, top_p, modelId)
+    response = brt.invoke_model(body=body, modelId=modelId, accept='application/json', contentType='application/json')
+    return utils.parse_response_body(json.loads(response.get('body').read()), modelId)
+
+
+def measure(fn, args):
+    messages = [{"role": "user", "content": "What is the most spoken language in the world?"}]
+
+    def call(_):
+        return fn(messages, use_temp=0.15, modelId=args.model_name)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(call, range(args.calls)))
+    return args.calls / (time.perf_counter() - start)
+
+
+def measure_async(args):
+    messages = [{"role": "user", "content": "What is the most spoken language in the world?"}]
+
+    async def run_all():
+        await asyncio.gather(*[utils.ask_model_async(messages, use_temp=0.15, modelId=args.model_name)
+                               for _ in range(args.calls)])
+
+    start = time.perf_counter()
+    asyncio.run(run_all())
+    return args.calls / (time.perf_counter() - start)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="meta.llama3-70b-instruct-v1:0", help="model id sent to the stub")
+    parser.add_argument("--calls", type=int, default=500, help="number of calls per variant")
+    parser.add_argument("--threads", type=int, default=1, help="concurrent callers")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated server latency in seconds")
+    parser.add_argument("--async_concurrency", type=int, default=0, help="also measure ask_model_async with this many requests in flight")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    # the stub does not check signatures, but botocore needs credentials to sign with
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = StubServer(latency=args.latency).start()
+    utils.client_config['endpoint_url'] = server.url
+    utils.reset_clients()
+
+    before = measure(ask_model_fresh_client, args)
+    after = measure(utils.ask_model, args)
+    result = {
+        "calls": args.calls,
+        "threads": args.threads,
+        "latency": args.latency,
+        "fresh_client_calls_per_second": round(before, 1),
+        "pooled_client_calls_per_second": round(after, 1),
+        "speedup": round(after / before, 2),
+    }
+    if args.async_concurrency > 0:
+        utils.set_async_concurrency(args.async_concurrency)
+        result["async_concurrency"] = args.async_concurrency
+        result["async_calls_per_second"] = round(measure_async(args), 1)
+    server.stop()
+
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
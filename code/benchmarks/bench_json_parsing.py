@@ -0,0 +1,116 @@
+import json
+import argparse
+from ..response_parsing import parse_clusters
+
+
+# Replays clustering responses through the old inline parse ('{' + split('{')[1].split('}')[0] + '}')
+# and through response_parsing.parse_clusters. Every response the old parse rejects cost the pipeline a
+# regeneration call (768 output tokens at most), so the responses only the new parser reads correctly are
+# retries avoided. The built-in corpus holds the kinds of malformed output seen in the logs; --corpus adds more,
+# as a JSON list of {"response": ..., "expected": {...} or null} (null for responses with no usable mapping).
+CORPUS = [
+    {"response": '{\n    "Paris is the capital of France.": [1, 2, 3, 4, 5]\n}',
+     "expected": {"Paris is the capital of France.": [1, 2, 3, 4, 5]}},
+    {"response": '{"Dominick Bellizzi is an actor.": [2,3,5], "Dominick Bellizzi is a professional wrestler.": [1,4]}',
+     "expected": {"Dominick Bellizzi is an actor.": [2, 3, 5], "Dominick Bellizzi is a professional wrestler.": [1, 4]}},
+    {"response": "{'The 100 meters.': [3,4], 'There is no record that was broken by Usain Bolt.': [1,2,5]}",
+     "expected": {"The 100 meters.": [3, 4], "There is no record that was broken by Usain Bolt.": [1, 2, 5]}},
+    {"response": "{\n    'Edgar Allan Poe's occupation is a writer and editor.': [4],\n    'Edgar Allan Poe's occupation is a writer, editor, and literary critic': [1,2,3,5]\n}",
+     "expected": {"Edgar Allan Poe's occupation is a writer and editor.": [4],
+                  "Edgar Allan Poe's occupation is a writer, editor, and literary critic": [1, 2, 3, 5]}},
+    {"response": '```json\n{\n    "The Pacific Ocean.": [1, 2, 4],\n    "The Atlantic Ocean.": [3, 5],\n}\n```',
+     "expected": {"The Pacific Ocean.": [1, 2, 4], "The Atlantic Ocean.": [3, 5]}},
+    {"response": 'Here is the grouping:\n\n```\n{"1969": [1,2,3,4,5],}\n```\nAll answers agree.',
+     "expected": {"1969": [1, 2, 3, 4, 5]}},
+    {"response": '{\n    "Mount Kilimanjaro.": ["1", "2", "3"],\n    "Mount Kenya.": ["4", "5"]\n}',
+     "expected": {"Mount Kilimanjaro.": [1, 2, 3], "Mount Kenya.": [4, 5]}},
+    {"response": '{"Marie Curie.": [1.0, 2.0, 3.0, 4.0], "Pierre Curie.": [5.0]}',
+     "expected": {"Marie Curie.": [1, 2, 3, 4], "Pierre Curie.": [5]}},
+    {"response": '{"Iron.": ["Answer 1", "Answer 2", "Answer 3", "Answer 5"], "Fe is tin.": ["Answer 4"]}',
+     "expected": {"Iron.": [1, 2, 3, 5], "Fe is tin.": [4]}},
+    {"response": '{"clusters": {"Canberra.": [1, 2, 3, 5], "Sydney.": [4]}}',
+     "expected": {"Canberra.": [1, 2, 3, 5], "Sydney.": [4]}},
+    {"response": '{"The set {1, 2} is the answer.": [1, 2, 3], "None of them.": [4, 5]}',
+     "expected": {"The set {1, 2} is the answer.": [1, 2, 3], "None of them.": [4, 5]}},
+    {"response": '{\n    "Michelangelo.": [1, 2, 3, 4],\n    "Raphael.": [5',
+     "expected": {"Michelangelo.": [1, 2, 3, 4], "Raphael.": [5]}},
+    {"response": '{"The novel is \\"Do Androids Dream of Electric Sheep?\\" by Philip K. Dick.": [1, 2, 3, 4, 5]}',
+     "expected": {'The novel is "Do Androids Dream of Electric Sheep?" by Philip K. Dick.': [1, 2, 3, 4, 5]}},
+    {"response": '{\n  "Saturn.": [1, 3, 4],\n  "Jupiter.": [2, 5]\n}\nNote that answers 2 and 5 are older data.',
+     "expected": {"Saturn.": [1, 3, 4], "Jupiter.": [2, 5]}},
+    {"response": "{'Spanish.': '1, 2', 'Mandarin Chinese.': '3, 4, 5'}",
+     "expected": {"Spanish.": [1, 2], "Mandarin Chinese.": [3, 4, 5]}},
+    {"response": "I cannot determine the groups without more information.",
+     "expected": None},
+    {"response": "{}",
+     "expected": None},
+    {"response": '{"Amazon River.": []}',
+     "expected": None},
+]
+
+
+def legacy_parse(response):
+    if '{' in response and '}' in response:
+        return json.loads('{' + response.split('{')[1].split('}')[0] + '}')
+    raise ValueError('no JSON object in the response')
+
+
+def normalize(clusters):
+    # the pipelines only use integer agent ids, everything else is filtered out afterwards
+    return {key: [v for v in value if isinstance(v, int) and not isinstance(v, bool) and v > 0]
+            for key, value in clusters.items() if isinstance(value, list)}
+
+
+def replay(parse, entry):
+    # "ok" if the mapping matches, "wrong" if something parsed but differs, "failed" if it would be regenerated
+    try:
+        clusters = normalize(parse(entry["response"]))
+    except ValueError:
+        return "failed"
+    clusters = {key: value for key, value in clusters.items() if value}
+    if entry["expected"] is None:
+        return "wrong" if clusters else "failed"
+    return "ok" if clusters == entry["expected"] else "wrong"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=str, default=None, help="JSON list of logged responses to add to the built-in corpus")
+    parser.add_argument("--verbose", action="store_true", help="print the outcome of every response")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    corpus = list(CORPUS)
+    if args.corpus is not None:
+        corpus += json.load(open(args.corpus))
+
+    outcomes = {"legacy": [], "tolerant": []}
+    for entry in corpus:
+        legacy = replay(legacy_parse, entry)
+        tolerant = replay(parse_clusters, entry)
+        outcomes["legacy"].append(legacy)
+        outcomes["tolerant"].append(tolerant)
+        if args.verbose:
+            print(f"{legacy:>7} {tolerant:>7}  {entry['response'][:80]!r}")
+
+    usable = [entry["expected"] is not None for entry in corpus]
+    result = {
+        "responses": len(corpus),
+        "usable_responses": sum(usable),
+    }
+    for name, results in outcomes.items():
+        result[name] = {outcome: results.count(outcome) for outcome in ("ok", "wrong", "failed")}
+    # a response the old parse rejected or misread (string ids end up filtered out and trigger the
+    # "you are not including the answer ..." re-prompt) but the tolerant one recovers saves a call
+    result["avoided_retries"] = sum(legacy != "ok" and tolerant == "ok"
+                                    for legacy, tolerant in zip(outcomes["legacy"], outcomes["tolerant"]))
+    result["necessary_retries"] = sum(not entry_usable for entry_usable in usable)
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import resource
+import tempfile
+import importlib
+import subprocess
+from contextlib import redirect_stdout
+import numpy as np
+
+
+# End-to-end throughput of every stage on a synthetic dataset, answered by the mock backend (--backend mock).
+# Each stage runs its own main() in a fresh process, in pipeline order, so later stages read the files written
+# by earlier ones and peak RSS is measured per stage. Per-question latency is the time between consecutive
+# result records, so it is only meaningful for stages that process one question at a time.
+STAGES = [
+    ("question_generation", "code.question_generation.pipeline_question_generation"),
+    ("question_selection", "code.question_generation.pipeline_question_selection"),
+    ("agent_interaction", "code.agent_interaction.pipeline_agent_interaction"),
+    ("agent_evaluation", "code.evaluation.agent_evaluation"),
+    ("vanilla_qa", "code.baseline.vanilla_qa"),
+    ("vanilla_evaluation", "code.evaluation.vanilla_evaluation"),
+]
+
+RESULT_DIRS = ["question_generation", "question", "agent_interaction", "final_answer/agent", "baseline",
+               "final_answer/baseline"]
+
+
+class HashingEncoder:
+    # stand-in for the sentence embedding model, which cannot be downloaded offline: hashed bag of words
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                embeddings[i, int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def write_dataset(file_dic, dataset_name, num_questions):
+    for result_dir in RESULT_DIRS:
+        os.makedirs(os.path.join(file_dic, 'result', result_dir), exist_ok=True)
+    os.makedirs(os.path.join(file_dic, 'data'), exist_ok=True)
+    data = [{"question": f"What is the capital of region {i}?", "gold_answer": "Paris"} for i in range(num_questions)]
+    json.dump(data, open(os.path.join(file_dic, 'data', dataset_name + '.json'), "w"), indent=4)
+
+
+def run_stage(result_path, module_name, stage_argv):
+    # runs inside the stage process; writes the measurements as JSON to result_path, since the stage and its
+    # atexit handlers (--metrics, --cache_path) may print anything to stdout
+    from ..result_io import ResultWriter
+    from ..embedding import EmbeddingService
+    from .. import utils
+
+    record_times = []
+    write = ResultWriter.write
+
+    def timed_write(self, obj):
+        write(self, obj)
+        record_times.append(time.perf_counter())
+
+    ResultWriter.write = timed_write
+    # every embedding service of the stage, whatever its model name or --embedding_cache_dir
+    encoder = HashingEncoder()
+    EmbeddingService.model = property(lambda self: encoder)
+
+    module = importlib.import_module(module_name)
+    sys.argv = [module_name] + stage_argv
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        module.main()
+    elapsed = time.perf_counter() - start
+
+    num_questions = len(record_times)
+    latencies = np.diff([start] + record_times)
+    calls = utils._backend.stats()["calls"] if utils._backend is not None else 0
+    result = {
+        "questions": num_questions,
+        "seconds": round(elapsed, 3),
+        "questions_per_second": round(num_questions / elapsed, 3) if elapsed > 0 else 0.0,
+        "llm_calls": calls,
+        "llm_calls_per_question": round(calls / num_questions, 2) if num_questions else 0.0,
+        "p50_latency_s": round(float(np.percentile(latencies, 50)), 4) if num_questions else 0.0,
+        "p95_latency_s": round(float(np.percentile(latencies, 95)), 4) if num_questions else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="meta.llama3-70b-instruct-v1:0", help="model id passed to every stage")
+    parser.add_argument("--num_questions", type=int, default=20, help="size of the synthetic dataset")
+    parser.add_argument("--mock_seed", type=int, default=0, help="seed of the mock backend")
+    parser.add_argument("--mock_latency", type=float, default=0.05, help="simulated seconds per model call")
+    parser.add_argument("--mock_token_latency", type=float, default=0.0, help="simulated seconds per output token")
+    parser.add_argument("--mock_failure_rate", type=float, default=0.0, help="fraction of malformed responses for retried prompts")
+    parser.add_argument("--stages", type=str, default=",".join(name for name, _ in STAGES), help="comma separated stages to run, in pipeline order")
+    parser.add_argument("--stage_args", type=str, action="append", default=[], help="extra arguments of one stage, e.g. 'agent_interaction=--parallel_agents'")
+    parser.add_argument("--work_dir", type=str, default=None, help="directory for the dataset and results (a temporary one by default)")
+    parser.add_argument("--output", type=str, default=None, help="also write the JSON report to this file")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    if sys.argv[1:2] == ['--run_stage']:
+        # a stage process started below: the remaining arguments belong to the stage
+        run_stage(sys.argv[2], sys.argv[3], sys.argv[4:])
+        return
+
+    args = parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_pipelines_')
+    dataset_name = 'synthetic'
+    write_dataset(work_dir, dataset_name, args.num_questions)
+
+    extra_args = dict()
+    for stage_args in args.stage_args:
+        name, stage_arg_string = stage_args.split('=', 1)
+        extra_args[name] = shlex.split(stage_arg_string)
+
+    common = ["--backend", "mock", "--file_dic", work_dir, "--dataset_name", dataset_name,
+              "--model_name", args.model_name, "--mock_seed", str(args.mock_seed),
+              "--mock_latency", str(args.mock_latency), "--mock_token_latency", str(args.mock_token_latency),
+              "--mock_failure_rate", str(args.mock_failure_rate)]
+    selected = args.stages.split(',')
+
+    report = {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "stages": dict(),
+    }
+    report["config"]["work_dir"] = work_dir
+    for name, module_name in STAGES:
+        if name not in selected:
+            continue
+        stage_argv = common + extra_args.get(name, [])
+        if name.endswith('evaluation'):
+            stage_argv += ["--testing_model_name", args.model_name]
+        result_path = os.path.join(work_dir, name + '.bench.json')
+        if os.path.exists(result_path):
+            os.remove(result_path)
+        command = [sys.executable, '-m', 'code.benchmarks.bench_pipelines', '--run_stage', result_path, module_name] + stage_argv
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            report["stages"][name] = {"error": completed.stderr.strip().split('\n')[-1]}
+            continue
+        try:
+            report["stages"][name] = json.load(open(result_path))
+        except (OSError, ValueError) as e:
+            report["stages"][name] = {"error": "no measurements from the stage: " + str(e)}
+
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        json.dump(report, open(args.output, "w"), indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import argparse
+import threading
+from .stub_server import StubServer
+from .. import utils
+from ..llm_metrics import estimate_tokens
+from ..question_generation.pipeline_question_generation import Pipeline
+
+
+# Compares the two-call aspect path (topic_sampling then topic_ordering) with the fused single call
+# (--fused_topic) on a fixed question set. The stub charges a fixed latency per request plus a decode
+# time per output token, and counts tokens as roughly four characters each.
+QUESTIONS = [
+    "What is the most spoken language in the world?",
+    "Who wrote the novel that the film Blade Runner is based on?",
+    "In which year did the Berlin Wall fall?",
+    "What is the capital city of Australia?",
+    "Which element has the chemical symbol Fe?",
+    "Who painted the ceiling of the Sistine Chapel?",
+    "What is the longest river in South America?",
+    "Which planet has the most known moons?",
+    "Who was the first woman to win a Nobel Prize?",
+    "What is the tallest mountain in Africa?",
+]
+
+ASPECTS = ["historical background", "geographical context", "notable figures", "cultural significance", "scientific facts"]
+
+
+class TopicResponder:
+
+    def __init__(self, token_latency):
+        self.token_latency = token_latency
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, modelId, request_body):
+        prompt = request_body.get('prompt', '')
+        if 'numbered line' in prompt:
+            text = '\n'.join(f'{i + 1}. {aspect}' for i, aspect in enumerate(ASPECTS))
+        elif 'Please order the aspects' in prompt:
+            text = '\n'.join(reversed(ASPECTS))
+        else:
+            text = '\n'.join(ASPECTS)
+        with self._lock:
+            self.input_tokens += estimate_tokens(prompt)
+            self.output_tokens += estimate_tokens(text)
+        time.sleep(self.token_latency * estimate_tokens(text))
+        return text
+
+    def reset(self):
+        with self._lock:
+            self.input_tokens = 0
+            self.output_tokens = 0
+
+
+def measure(pipeline, server, responder, questions):
+    server.num_requests = 0
+    responder.reset()
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        aspects, _, _ = pipeline.sample_ordered_topics(question)
+        latencies.append(time.perf_counter() - start)
+        assert len(aspects) == len(ASPECTS)
+    return {
+        "calls": server.num_requests,
+        "mean_latency_ms": round(1000 * sum(latencies) / len(latencies), 1),
+        "input_tokens": responder.input_tokens,
+        "output_tokens": responder.output_tokens,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="meta.llama3-70b-instruct-v1:0", help="model id sent to the stub")
+    parser.add_argument("--latency", type=float, default=0.3, help="simulated time to first token, in seconds")
+    parser.add_argument("--token_latency", type=float, default=0.02, help="simulated decode time per output token, in seconds")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    responder = TopicResponder(args.token_latency)
+    server = StubServer(latency=args.latency, responder=responder).start()
+    utils.client_config['endpoint_url'] = server.url
+    utils.reset_clients()
+
+    pipeline_args = argparse.Namespace(model_name=args.model_name, num_agents=1, conceptualized_question=False,
+                                       parallel_aspects=False, fused_topic=False)
+    two_call = measure(Pipeline(pipeline_args), server, responder, QUESTIONS)
+    pipeline_args.fused_topic = True
+    fused = measure(Pipeline(pipeline_args), server, responder, QUESTIONS)
+    server.stop()
+
+    result = {
+        "questions": len(QUESTIONS),
+        "two_call": two_call,
+        "fused": fused,
+        "latency_speedup": round(two_call["mean_latency_ms"] / fused["mean_latency_ms"], 2),
+        "input_token_ratio": round(fused["input_tokens"] / two_call["input_tokens"], 2),
+    }
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A local stand-in for the Bedrock runtime endpoint: answers POST /model/<modelId>/invoke with a
+# well-formed llama or claude response body after an optional simulated latency.
+def default_responder(modelId, request_body):
+    return "OK"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one segment, otherwise Nagle and delayed ACKs stall every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request_body = json.loads(self.rfile.read(length) or b'{}')
+        modelId = self.path.split('/')[2] if self.path.startswith('/model/') else ''
+        modelId = modelId.replace('%3A', ':').replace('%2F', '/')
+
+        self.server.count_request()
+        try:
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+            text = self.server.responder(modelId, request_body)
+        finally:
+            self.server.end_request()
+        if 'claude' in modelId:
+            body = {"content": [{"type": "text", "text": text}]}
+        else:
+            body = {"generation": text}
+        payload = json.dumps(body).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.0, responder=default_responder):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.responder = responder
+        self.num_requests = 0
+        # requests being answered right now, and the most there ever were at once
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count_request(self):
+        with self._lock:
+            self.num_requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def end_request(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+from .embedding_store import EmbeddingStore, stored_dim
+
+
+DEFAULT_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+
+class EmbeddingService:
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL, batch_size=64, cache_dir=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self._model = None
+        self._store = None
+        self._lock = threading.RLock()
+
+    @property
+    def model(self):
+        # loaded on first use, once per process
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _dim(self):
+        # taken from the store when it exists, so a run whose texts are all stored never loads the model
+        if self.cache_dir is not None:
+            dim = stored_dim(self.cache_dir, self.model_name)
+            if dim is not None:
+                return dim
+        return self.model.get_sentence_embedding_dimension()
+
+    @property
+    def store(self):
+        if self._store is None and self.cache_dir is not None:
+            with self._lock:
+                if self._store is None:
+                    self._store = EmbeddingStore(self.cache_dir, self.model_name, self._dim())
+        return self._store
+
+    def _encode(self, texts):
+        # one batched forward pass; unit-length rows make cosine similarity a dot product
+        embeddings = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                       normalize_embeddings=True, show_progress_bar=False)
+        return embeddings.astype(np.float32, copy=False)
+
+    def encode(self, texts):
+        texts = list(texts)
+        if len(texts) == 0:
+            return np.zeros((0, self._dim()), dtype=np.float32)
+        if self.store is None:
+            return self._encode(texts)
+
+        # only texts missing from the on-disk store are encoded, still as one batch
+        embeddings, missing = self.store.get_many(texts)
+        if missing:
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_embeddings = self._encode(missing_texts)
+            self.store.put_many(missing_texts, new_embeddings)
+            position = {text: i for i, text in enumerate(missing_texts)}
+            for i in missing:
+                embeddings[i] = new_embeddings[position[texts[i]]]
+        return embeddings
+
+    def stats(self):
+        if self._store is None:
+            return None
+        return self._store.stats()
+
+    def similarity(self, query, candidates):
+        embeddings = self.encode([query] + list(candidates))
+        return (embeddings[1:] @ embeddings[0]).tolist()
+
+    def similarity_matrix(self, texts):
+        embeddings = self.encode(texts)
+        return embeddings @ embeddings.T
+
+
+_services = dict()
+_services_lock = threading.Lock()
+
+
+def get_embedding_service(model_name=DEFAULT_EMBEDDING_MODEL, cache_dir=None):
+    with _services_lock:
+        key = (model_name, cache_dir)
+        if key not in _services:
+            _services[key] = EmbeddingService(model_name, cache_dir=cache_dir)
+        return _services[key]
@@ -0,0 +1,124 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import numpy as np
+
+
+# Persistent store of sentence embeddings, one directory per embedding model:
+#   vectors.f32  raw float32 rows, append-only and memory-mapped for reading
+#   index.txt    one "<sha1 of text> <row>" line per stored vector
+# Writers append under an exclusive file lock and write a row before its index line, so any number
+# of processes can read while one of them appends.
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def stored_dim(directory, model_name):
+    # dimension recorded by an existing store, None if there is none yet
+    meta_path = os.path.join(directory, model_name.replace('/', '--'), 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    return json.load(open(meta_path))['dim']
+
+
+class EmbeddingStore:
+
+    def __init__(self, directory, model_name, dim):
+        self.path = os.path.join(directory, model_name.replace('/', '--'))
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, 'vectors.f32')
+        self.index_path = os.path.join(self.path, 'index.txt')
+        self.lock_path = os.path.join(self.path, 'lock')
+        self.dim = dim
+        self.row_bytes = dim * 4
+
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            meta = json.load(open(meta_path))
+            if meta['dim'] != dim:
+                raise ValueError(f"Embedding store {self.path} holds {meta['dim']}-d vectors, not {dim}-d")
+        else:
+            json.dump({"model_name": model_name, "dim": dim}, open(meta_path, "w"))
+        for path in (self.vectors_path, self.index_path):
+            open(path, 'ab').close()
+
+        self.index = dict()
+        self._index_offset = 0
+        self._vectors = None
+        self._rows_mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _refresh_index(self):
+        # pick up rows appended by other processes since the last read; a partly written last line is left for later
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            key, row = line.split()
+            self.index[key] = int(row)
+        self._index_offset += end
+
+    def _row(self, row):
+        if row >= self._rows_mapped:
+            rows = os.path.getsize(self.vectors_path) // self.row_bytes
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+            self._rows_mapped = rows
+        return self._vectors[row]
+
+    def get_many(self, texts):
+        # Returns an array with the stored rows filled in, and the positions of the texts that are missing.
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        with self._lock:
+            keys = [text_key(text) for text in texts]
+            if any(key not in self.index for key in keys):
+                self._refresh_index()
+            for i, key in enumerate(keys):
+                row = self.index.get(key)
+                if row is None:
+                    missing.append(i)
+                else:
+                    embeddings[i] = self._row(row)
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return embeddings, missing
+
+    def put_many(self, texts, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock, open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh_index()
+                new_rows = [(text_key(text), embeddings[i]) for i, text in enumerate(texts)]
+                new_rows = [(key, embedding) for key, embedding in dict(new_rows).items() if key not in self.index]
+                if not new_rows:
+                    return
+                first_row = os.path.getsize(self.vectors_path) // self.row_bytes
+                # drop a row left half-written by a crashed writer so new rows stay aligned
+                os.truncate(self.vectors_path, first_row * self.row_bytes)
+                with open(self.vectors_path, 'ab') as f:
+                    for key, embedding in new_rows:
+                        f.write(embedding.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with open(self.index_path, 'a') as f:
+                    for i, (key, embedding) in enumerate(new_rows):
+                        f.write(key + ' ' + str(first_row + i) + '\n')
+                self._refresh_index()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.index),
+        }
@@ -1,7 +1,11 @@
-import json
 import argparse
 from collections import defaultdict
-from ..utils import ask_model
+from ..utils import ask_with_retries, add_model_args, configure_model
+from ..response_parsing import parse_guess
+from ..unknown_detection import check_unknown, unknown_stats
+from ..llm_metrics import set_call_context
+from ..result_io import open_results, read_results, add_result_args
+
 
 class Pipeline:
 
@@ -43,73 +47,16 @@ class Pipeline:
 
         print(message)
 
-        attempts = 0
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-            try:
-                guess = response.split(':')[1].split('\n')[0].strip()
-            except (IndexError, json.JSONDecodeError) as e:
-                print(f"Failed to generate an extracted answer on attempt {attempts + 1}: {e}")
-            attempts += 1
+        result = ask_with_retries(message, parse_guess, self.max_retries, use_temp=0.15, modelId=self.modelId)
+        guess = result.value if result.ok else ''
+        response = result.response
 
         print(guess, response)
 
         return guess, response
 
     def check_unknown(self, answer):
-
-        # if we have a new model, use this prompt, otherwise for claude3 and llama3, the uncertainty phrases are more accuate.
-
-        message = [
-            {
-                "role": "system",
-                "content": """Evaluate the model's response to determine if it indicates uncertainty. Use the following steps:
-                1. Check if the response contains any phrases from a predefined list of "uncertainty phrases" or similar expressions. These phrases indicate that the model does not know the answer.
-                2. If any uncertainty phrase or similar expressions is present, return "I don't know".
-                3. If no uncertainty phrase is present, return the original response exactly as is, without any changes or added explanation.
-
-                Uncertainty phrases include:
-                [
-                    "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
-                    "is not definitively known", "is uncertain", "does not mention", "there is no information",
-                    "does not provide", "there is not enough information provided to determine", "cannot be determined",
-                    "is not provided", "is not known", "The response does not provide any information",
-                    "The response does not provide enough information", "There is no answer.", "is unclear",
-                    "remains uncertain",
-                    "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
-                    "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
-                    "there is no definitive",
-                    "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
-                    "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
-                    "you do not have enough verified information",
-                    "I don't have enough information", "I need more context", "I apologize, ",
-                    "The question cannot be answered", "no factual information", "not enough factual information",
-                    "does not have enough factual information", "does not actually have any factual information", "Unknown", 
-                    "couldn't find any information", "There is no information available", "There is no information",
-                    "There is not enough information", "I need more information to"
-                ]"""
-            },
-            {
-                "role": "user",
-                "content": "The response does not provide enough information to determine the answer.",
-            },
-            {
-                "role": "assistant",
-                "content": "I don't know"
-            },
-            {
-                "role": "user",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin.",
-            },
-            {
-                "role": "assistant",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin."
-            },
-        ]
-
-        message.append({"role": "user", "content": answer})
-        response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-        return response
+        return check_unknown(answer, self.modelId)
 
 
 def parse_args():
@@ -128,6 +75,8 @@ def parse_args():
     parser.add_argument("--max_retries", type=int, default=5, help="max_retries")
     parser.add_argument("--threshold", type=float, default=0.97, help="threshold")
     parser.add_argument("--mode", type=str, default="origin", help="max_retries")
+    add_model_args(parser)
+    add_result_args(parser)
 
     args = parser.parse_args()
     return args
@@ -135,21 +84,26 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
     pipe = Pipeline(args)
 
-    with open(
+    df_all = read_results(
             args.file_dic + "/result/agent_interaction/" + args.dataset_name + "_" + args.save_file + "_" + args.model_name.replace(
-                    '/', '-') + "_0_" + args.mode + ".json") as f:
-        df_all = json.load(f)
+                    '/', '-') + "_0_" + args.mode + ".json")
 
-    out_objs = []
+    writer, completed = open_results(
+            args.file_dic + "/result/final_answer/agent/" + args.dataset_name + "_" + args.save_file + "_" + args.model_name.replace(
+                '/', '-') + "_" + str(
+                args.start) + "_" + args.mode + ".json", args.resume)
 
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
         print(i)
+        set_call_context(question=i)
         print(df['question'])
         if len(df['final_answer']) != 0:
             # agent
@@ -178,15 +132,13 @@ def main():
             "agent_final_answer": predict_answer,
             "agent_answer": df['final_answer'],
             "uncertainty_score": df['uncertainty_score'],
-            "evaluation": guess
+            "evaluation": guess,
+            "id": i
         }
-        out_objs.append(obj)
+        writer.write(obj)
 
-        json.dump(out_objs, open(
-            args.file_dic + "/result/final_answer/agent/" + args.dataset_name + "_" + args.save_file + "_" + args.model_name.replace(
-                '/', '-') + "_" + str(
-                args.start) + "_" + args.mode + ".json",
-            "w"), indent=4)
+    writer.close()
+    print('check_unknown: ', unknown_stats())
 
 
 if __name__ == '__main__':
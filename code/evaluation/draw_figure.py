@@ -1,69 +1,41 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.metrics import precision_recall_curve
-import json
 import argparse
 from collections import defaultdict
-from ..utils import ask_model
-
-def check_unknown(answer, modelId):
-
-    # if we have a new model, use this prompt, otherwise for claude3 and llama3, the uncertainty phrases are more accuate.
-
-    message = [
-        {
-            "role": "system",
-            "content": """Evaluate the model's response to determine if it indicates uncertainty. Use the following steps:
-            1. Check if the response contains any phrases from a predefined list of "uncertainty phrases" or similar expressions. These phrases indicate that the model does not know the answer.
-            2. If any uncertainty phrase or similar expressions is present, return "I don't know".
-            3. If no uncertainty phrase is present, return the original response exactly as is, without any changes or added explanation.
-
-            Uncertainty phrases include:
-            [
-                "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
-                "is not definitively known", "is uncertain", "does not mention", "there is no information",
-                "does not provide", "there is not enough information provided to determine", "cannot be determined",
-                "is not provided", "is not known", "The response does not provide any information",
-                "The response does not provide enough information", "There is no answer.", "is unclear",
-                "remains uncertain",
-                "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
-                "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
-                "there is no definitive",
-                "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
-                "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
-                "you do not have enough verified information",
-                "I don't have enough information", "I need more context", "I apologize, ",
-                "The question cannot be answered", "no factual information", "not enough factual information",
-                "does not have enough factual information", "does not actually have any factual information", "Unknown",
-                "couldn't find any information", "There is no information available", "There is no information",
-                "There is not enough information", "I need more information to"
-            ]"""
-        },
-        {
-            "role": "user",
-            "content": "The response does not provide enough information to determine the answer.",
-        },
-        {
-            "role": "assistant",
-            "content": "I don't know"
-        },
-        {
-            "role": "user",
-            "content": "It takes repeated uses over a short space of time to become physically addicted to heroin.",
-        },
-        {
-            "role": "assistant",
-            "content": "It takes repeated uses over a short space of time to become physically addicted to heroin."
-        },
-    ]
-
-    message.append({"role": "user", "content": answer})
-    response = ask_model(message, use_temp=0.15, modelId=modelId)
-    return response
+from ..utils import add_model_args, configure_model
+from ..unknown_detection import check_unknown, unknown_stats
+from ..result_io import read_results
 
 
 # You need to define the threshold logic and compute recall and precision for each threshold
-def compute_precision_recall(scores, evaluations, unknown_labels, thresholds):
+def compute_precision_recall(scores, evaluations, unknown_labels, thresholds=None):
+    # For a threshold t the model answers every query with score <= t that is not 'I don't know', which is a
+    # prefix of those queries sorted by score. Sorting once and taking cumulative sums gives precision and recall
+    # for all thresholds in O(N log N); with thresholds=None the curve has one point per distinct score.
+    scores = np.asarray(scores, dtype=float)
+    evaluations = np.asarray(evaluations, dtype=float)
+    known = ~np.asarray(unknown_labels, dtype=bool)
+    total_queries = len(scores)
+
+    order = np.argsort(scores[known], kind='stable')
+    sorted_scores = scores[known][order]
+    correct = np.cumsum(evaluations[known][order])
+
+    if thresholds is None:
+        thresholds = np.unique(sorted_scores)
+    answered = np.searchsorted(sorted_scores, np.asarray(thresholds, dtype=float), side='right')
+    # thresholds under which the model abstains on everything have no precision
+    answered = answered[answered > 0]
+
+    precisions = correct[answered - 1] / answered
+    recalls = answered / total_queries
+    return precisions, recalls
+
+
+# Reference implementation of compute_precision_recall: re-scans every score for each threshold.
+# code/tests/test_precision_recall.py checks that both give the same curve.
+def compute_precision_recall_loop(scores, evaluations, unknown_labels, thresholds):
     precisions = []
     recalls = []
     total_queries = len(scores)
@@ -145,6 +117,7 @@ def parse_args():
     parser.add_argument("--max_retries", type=int, default=5, help="max_retries")
     parser.add_argument("--threshold", type=float, default=0.97, help="threshold")
     parser.add_argument("--mode", type=str, default="main", help="threshold")
+    add_model_args(parser)
 
 
 
@@ -158,13 +131,13 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
 
     plt.figure(figsize=(10, 6))
     plt.rcParams.update({'font.size': 14})
 
-    with open(args.file_dic + "/result/final_answer/baseline/" + args.dataset_name + "_vanilla_qa_"  + args.model_name.replace('/','-') + "_" + "0.json") as f:
-        df_vanilla = json.load(f)
+    df_vanilla = read_results(args.file_dic + "/result/final_answer/baseline/" + args.dataset_name + "_vanilla_qa_"  + args.model_name.replace('/','-') + "_" + "0.json")
 
     uncertainty_score, evaluation, unknown_labels = get_data(df_vanilla, args.testing_model_name)
 
@@ -181,10 +154,9 @@ def main():
     plt.plot(recalls, precisions, label='SemanticEntropy', color='green', linestyle='--', linewidth=3)
 
 
-    with open(
+    df_all = read_results(
             args.file_dic + "/result/final_answer/agent/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') + "_" + str(
-                args.start) + "_origin.json") as f:
-        df_all = json.load(f)
+                args.start) + "_origin.json")
 
     uncertainty_score, evaluation, unknown_labels = get_data(df_all, args.testing_model_name)
     precisions, recalls = compute_precision_recall(np.array(uncertainty_score), np.asarray(evaluation),
@@ -214,6 +186,7 @@ def main():
     plt.legend()
     plt.grid(True)
     plt.savefig(args.file_dic + "/result/figure/" + args.mode + "/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') + ".png")
+    print('check_unknown: ', unknown_stats())
     plt.show()
 
 
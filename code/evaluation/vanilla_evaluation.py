@@ -2,7 +2,149 @@ import json
 import argparse
 from collections import defaultdict
 import math
-from ..utils import ask_model
+from ..utils import ask_model, ask_with_retries, add_model_args, configure_model
+from ..response_parsing import parse_guess, parse_clusters
+from ..unknown_detection import check_unknown, unknown_stats
+from ..llm_metrics import set_call_context
+from ..result_io import open_results, read_results, add_result_args
+from ..answer_clustering import cluster_locally, keep_apart, add_precluster_args, precluster_service, add_dedup_args
+from ..prompt_prefix import PromptPrefix
+
+
+# few-shot prefix of check_answer_semantic_equivalence
+equivalence_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": "Strictly evaluate the semantic equivalence of the keys in the provided JSON given a question. Your response should strictly adhere to the JSON format provided, without additional explanations. Combine keys to the SIMPLER one only when they are definitively equivalent. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group."
+    },
+    {
+        "role": "user",
+        "content": """ Question: Who was the producer of Beaches?
+                Json: {
+                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
+                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
+                }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
+                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
+                }"""
+    },
+    {
+        "role": "user",
+        "content": """Question: who was the director of avatar?
+                Json: {
+                "James Cameron was the director of the 2009 film Avatar.": [
+                    3,
+                    4,
+                    5
+                ],
+                "James Cameron": [
+                    1,
+                    2
+                ]
+            }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                            "James Cameron": [1,2,3,4,5],
+                                        }"""
+    },
+    {
+        "role": "user",
+        "content": """Question: Does Izzie Stevens die in Grey's Anatomy?
+                Json: {
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is not killed off.": [1,5],
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [2,4],
+                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, and her character is written off as having moved away.": [3]
+                                }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                            "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [1,2,3,4,5]
+                                                        }"""
+    },
+    {
+        "role": "user",
+        "content": """Question: In what event was Harold Davis a former record holder, but now is held by Usain Bolt?
+                        Json: {
+                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
+                                                           "The 100 meters.": [3,4]
+                                                       }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
+                                                           "The 100 meters.": [3,4]
+                                                       }"""
+    },
+    {
+        "role": "user",
+        "content": """Question: When is Season 3 of Emily in Paris's release date?
+                Json: {
+                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
+                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
+                               }"""
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
+                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
+                               }"""
+    },
+])
+
+
+# few-shot prefix of check_answer_consistency
+consistency_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": """You are given a question and 5 answers. Your task is to identify unique answers by combining those with different phrasings but similar meanings into a single group. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group. Your response should strictly adhere to the JSON format provided, without additional explanations. Here’s the format to be used
+                                {
+                                    "the unique answer": <list the answer number. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group.>
+                                }
+                        """
+    },
+    {
+        "role": "user",
+        "content": "Question: What is Cecil Aldin's occupation?\n1. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n2. Cecil Aldin was a British artist and illustrator, best known for his animal illustrations, particularly dogs.\n3. Cecil Aldin was a British artist and illustrator, best known for his drawings of dogs and other animals.\n4. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n5. Cecil Aldin was a British artist and illustrator, best known for his animal and sporting artwork."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                               "Cecil Aldin was a British artist and illustrator, best known for his animal illustrations.": [1,2,3,4,5]
+                                           }"""
+    },
+    {
+        "role": "user",
+        "content": "Question: What is Dominick Bellizzi's occupation?\n1. Dominick Bellizzi is a professional wrestler.\n2. Dominick Bellizzi is an actor.\n3. Dominick Bellizzi is an actor.\n4. Dominick Bellizzi is an American professional wrestler.\n5. Dominick Bellizzi is an actor."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                   "Dominick Bellizzi is an actor.": [2,3,5],
+                                   "Dominick Bellizzi is a professional wrestler.": [1,4]
+                               }"""
+    },
+    {
+        "role": "user",
+        "content": "Question: What is Edgar Allan Poe's occupation?\n1. Edgar Allan Poe's occupation was a writer, editor, and literary critic.\n2. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n3. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n4. Edgar Allan Poe's occupation is a writer and editor.\n5. Edgar Allan Poe's occupation is a writer, editor, and literary critic."
+    },
+    {
+        "role": "assistant",
+        "content": """{
+                                                "Edgar Allan Poe's occupation is a writer and editor.": [4],
+                                                "Edgar Allan Poe's occupation is a writer, editor, and literary critic": [1,2,3,5]
+                                            }"""
+    },
+])
+
 
 class Pipeline:
 
@@ -17,6 +159,15 @@ class Pipeline:
         self.agents = agents
         self.original_question = ''
 
+        # Optional grouping of clearly equal / clearly different answers by embedding similarity
+        self.precluster = args.precluster
+        self.precluster_high = args.precluster_high
+        self.precluster_low = args.precluster_low
+        self.embedding_service = precluster_service(args)
+
+        # Group answers that are identical after normalization without asking the model
+        self.dedup_answers = args.dedup_answers
+
     def check_answer_semantic(self, question, model_answer, gold_answer, correct_answer=None):
         message = [
             {
@@ -46,168 +197,21 @@ class Pipeline:
 
         print(message)
 
-        attempts = 0
-        while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-            try:
-                guess = response.split(':')[1].split('\n')[0].strip()
-            except (IndexError, json.JSONDecodeError) as e:
-                print(f"Failed to generate an extracted answer on attempt {attempts + 1}: {e}")
-            attempts += 1
+        result = ask_with_retries(message, parse_guess, self.max_retries, use_temp=0.15, modelId=self.modelId)
+        guess = result.value if result.ok else ''
+        response = result.response
 
         print(guess, response)
 
         return guess, response
 
     def check_unknown(self, answer):
-
-        # if we have a new model, use this prompt, otherwise for claude3 and llama3, the uncertainty phrases are more accuate.
-
-        message = [
-            {
-                "role": "system",
-                "content": """Evaluate the model's response to determine if it indicates uncertainty. Use the following steps:
-                1. Check if the response contains any phrases from a predefined list of "uncertainty phrases" or similar expressions. These phrases indicate that the model does not know the answer.
-                2. If any uncertainty phrase or similar expressions is present, return "I don't know".
-                3. If no uncertainty phrase is present, return the original response exactly as is, without any changes or added explanation.
-
-                Uncertainty phrases include:
-                [
-                    "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
-                    "is not definitively known", "is uncertain", "does not mention", "there is no information",
-                    "does not provide", "there is not enough information provided to determine", "cannot be determined",
-                    "is not provided", "is not known", "The response does not provide any information",
-                    "The response does not provide enough information", "There is no answer.", "is unclear",
-                    "remains uncertain",
-                    "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
-                    "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
-                    "there is no definitive",
-                    "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
-                    "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
-                    "you do not have enough verified information",
-                    "I don't have enough information", "I need more context", "I apologize, ",
-                    "The question cannot be answered", "no factual information", "not enough factual information",
-                    "does not have enough factual information", "does not actually have any factual information", "Unknown", 
-                    "couldn't find any information", "There is no information available", "There is no information",
-                    "There is not enough information", "I need more information to"
-                ]"""
-            },
-            {
-                "role": "user",
-                "content": "The response does not provide enough information to determine the answer.",
-            },
-            {
-                "role": "assistant",
-                "content": "I don't know"
-            },
-            {
-                "role": "user",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin.",
-            },
-            {
-                "role": "assistant",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin."
-            },
-        ]
-
-        print(1, answer)
-        message.append({"role": "user", "content": answer})
-
-        response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-        print(2, response)
-
-        return response
+        return check_unknown(answer, self.modelId)
 
 
     def check_answer_semantic_equivalence(self, question, json_data):
 
-        message = [
-            {
-                "role": "system",
-                "content": "Strictly evaluate the semantic equivalence of the keys in the provided JSON given a question. Your response should strictly adhere to the JSON format provided, without additional explanations. Combine keys to the SIMPLER one only when they are definitively equivalent. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group."
-            },
-            {
-                "role": "user",
-                "content": """ Question: Who was the producer of Beaches?
-                Json: {
-                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
-                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
-                }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                      "the producers of the film Beaches were Bonnie Bruckheimer and Amanda Gruber.": [1,4,5],
-                      "the producers of the 1988 film Beaches were Garry Marshall and Bonnie Bruckheimer.": [2,3]
-                }"""
-            },
-            {
-                "role": "user",
-                "content": """Question: who was the director of avatar?
-                Json: {
-                "James Cameron was the director of the 2009 film Avatar.": [
-                    3,
-                    4,
-                    5
-                ],
-                "James Cameron": [
-                    1,
-                    2
-                ]
-            }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                            "James Cameron": [1,2,3,4,5],
-                                        }"""
-            },
-            {
-                "role": "user",
-                "content": """Question: Does Izzie Stevens die in Grey's Anatomy?
-                Json: {
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is not killed off.": [1,5],
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [2,4],
-                                    "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, and her character is written off as having moved away.": [3]
-                                }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                            "Izzie Stevens does not actually die in Grey's Anatomy. She leaves the show at the end of Season 6, but her character is still alive.": [1,2,3,4,5]
-                                                        }"""
-            },
-            {
-                "role": "user",
-                "content": """Question: In what event was Harold Davis a former record holder, but now is held by Usain Bolt?
-                        Json: {
-                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
-                                                           "The 100 meters.": [3,4]
-                                                       }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                           "There is no information that suggests Harold Davis held a world record in any event that was later broken by Usain Bolt.": [1,2,5],
-                                                           "The 100 meters.": [3,4]
-                                                       }"""
-            },
-            {
-                "role": "user",
-                "content": """Question: When is Season 3 of Emily in Paris's release date?
-                Json: {
-                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
-                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
-                               }"""
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                   "Season 3 of Emily in Paris has been confirmed, and it is scheduled to be released on December 21, 2022, on Netflix.": [1],
-                                   "Season 3 of Emily in Paris has been confirmed, but the release date has not been officially announced yet.": [2,3,4,5]
-                               }"""
-            },
-        ]
+        message = equivalence_prompt.copy()
 
         json_string = json.dumps(json_data, indent=4)  # 'indent' for pretty-printing
         # print(json_string)
@@ -221,12 +225,11 @@ class Pipeline:
                 message.append({"role": "assistant", "content": response})
                 message.append({"role": "user",
                                 "content": "You cannot generate single quotes in a json. Regenerate with double quotes."})
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, attempt=attempts, validate=parse_clusters)
             try:
-                if '{' in response and '}' in response:
-                    final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                    break
-            except json.JSONDecodeError:
+                final_response = parse_clusters(response)
+                break
+            except ValueError:
                 print(f"Failed to decode JSON on attempt {attempts + 1}")
             attempts += 1
 
@@ -255,12 +258,11 @@ class Pipeline:
             final_response = dict()
             attempts = 0
             while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
 
 
@@ -275,12 +277,11 @@ class Pipeline:
             final_response = dict()
             attempts = 0
             while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
 
                 attempts += 1
@@ -297,48 +298,19 @@ class Pipeline:
 
     def check_answer_consistency(self, question, model_answer):
 
-        message = [
-            {
-                "role": "system",
-                "content": """You are given a question and 5 answers. Your task is to identify unique answers by combining those with different phrasings but similar meanings into a single group. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group. Your response should strictly adhere to the JSON format provided, without additional explanations. Here’s the format to be used
-                                {
-                                    "the unique answer": <list the answer number. Each of the 5 answers [1,2,3,4,5] must be included in one, and only one, unique group.>
-                                }
-                        """
-            },
-            {
-                "role": "user",
-                "content": "Question: What is Cecil Aldin's occupation?\n1. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n2. Cecil Aldin was a British artist and illustrator, best known for his animal illustrations, particularly dogs.\n3. Cecil Aldin was a British artist and illustrator, best known for his drawings of dogs and other animals.\n4. Cecil Aldin was a British artist and illustrator, best known for his dog paintings and illustrations.\n5. Cecil Aldin was a British artist and illustrator, best known for his animal and sporting artwork."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                               "Cecil Aldin was a British artist and illustrator, best known for his animal illustrations.": [1,2,3,4,5]
-                                           }"""
-            },
-            {
-                "role": "user",
-                "content": "Question: What is Dominick Bellizzi's occupation?\n1. Dominick Bellizzi is a professional wrestler.\n2. Dominick Bellizzi is an actor.\n3. Dominick Bellizzi is an actor.\n4. Dominick Bellizzi is an American professional wrestler.\n5. Dominick Bellizzi is an actor."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                   "Dominick Bellizzi is an actor.": [2,3,5],
-                                   "Dominick Bellizzi is a professional wrestler.": [1,4]
-                               }"""
-            },
-            {
-                "role": "user",
-                "content": "Question: What is Edgar Allan Poe's occupation?\n1. Edgar Allan Poe's occupation was a writer, editor, and literary critic.\n2. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n3. Edgar Allan Poe's occupation is a writer, editor, and literary critic.\n4. Edgar Allan Poe's occupation is a writer and editor.\n5. Edgar Allan Poe's occupation is a writer, editor, and literary critic."
-            },
-            {
-                "role": "assistant",
-                "content": """{
-                                                "Edgar Allan Poe's occupation is a writer and editor.": [4],
-                                                "Edgar Allan Poe's occupation is a writer, editor, and literary critic": [1,2,3,5]
-                                            }"""
-            },
-        ]
+        clusters, settled = cluster_locally(model_answer, self.dedup_answers, self.embedding_service,
+                                            self.precluster_high, self.precluster_low)
+        if settled:
+            return clusters
+        if clusters is not None:
+            # the model compares the pre-grouped answers, and keep_apart undoes any merge it makes across a pair
+            # the embeddings found clearly different
+            groups = self.check_answer_semantic_equivalence(question, clusters)
+            if self.embedding_service is None:
+                return groups
+            return keep_apart(groups, clusters, model_answer, self.embedding_service, self.precluster_low)
+
+        message = consistency_prompt.copy()
 
         prompt = "Question: " + question
         for i in range(len(model_answer)):
@@ -349,12 +321,11 @@ class Pipeline:
         attempts = 0
 
         while attempts < self.max_retries:
-            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+            response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, attempt=attempts, validate=parse_clusters)
             try:
-                if '{' in response and '}' in response:
-                    final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                    break
-            except json.JSONDecodeError:
+                final_response = parse_clusters(response)
+                break
+            except ValueError:
                 print(f"Failed to decode JSON on attempt {attempts + 1}")
 
 
@@ -380,12 +351,11 @@ class Pipeline:
             final_response = dict()
             attempts = 0
             while attempts < self.max_retries:
-                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768)
+                response = ask_model(message, use_temp=0.15, modelId=self.modelId, max_token=768, attempt=attempts, validate=parse_clusters)
                 try:
-                    if '{' in response and '}' in response:
-                        final_response = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
-                        break
-                except json.JSONDecodeError:
+                    final_response = parse_clusters(response)
+                    break
+                except ValueError:
                     print(f"Failed to decode JSON on attempt {attempts + 1}")
                     # final_response_temp = response
 
@@ -501,26 +471,34 @@ def parse_args():
     parser.add_argument("--track_answer_revisions", type=bool, default=False, help="track_answer_revisions")
     parser.add_argument("--num_agents", type=int, default=5, help="num_agents")
     parser.add_argument("--max_rounds", type=int, default=5, help="max_rounds")
+    add_model_args(parser)
+    add_result_args(parser)
+    add_precluster_args(parser)
+    add_dedup_args(parser)
 
     args = parser.parse_args()
     return args
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
     pipe = Pipeline(args)
 
-    with open(
-             args.file_dic + "/result/baseline/" + args.dataset_name + "_" + args.save_file + "_"  + args.model_name.replace('/','-') + "_0.json") as f:
-        df_all = json.load(f)
+    df_all = read_results(
+             args.file_dic + "/result/baseline/" + args.dataset_name + "_" + args.save_file + "_"  + args.model_name.replace('/','-') + "_0.json")
 
-    out_objs = []
+    writer, completed = open_results(
+            args.file_dic + "/result/final_answer/baseline/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') + "_" + str(
+                args.start) + ".json", args.resume)
 
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
         print(i)
+        set_call_context(question=i)
         print(df['question'])
         print(df['gold_answer'])
 
@@ -551,15 +529,14 @@ def main():
             "agent_final_answer": predict_answer,
             "agent_answer": df['final_answer'],
             "uncertainty_score": df['uncertainty_score'],
-            "evaluation": guess
+            "evaluation": guess,
+            "id": i
         }
-        out_objs.append(obj)
+        writer.write(obj)
         print('\n')
 
-        json.dump(out_objs, open(
-            args.file_dic + "/result/final_answer/baseline/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') + "_" + str(
-                args.start) + ".json",
-            "w"), indent=4)
+    writer.close()
+    print('check_unknown: ', unknown_stats())
 
 
 if __name__ == '__main__':
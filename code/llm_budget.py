@@ -0,0 +1,65 @@
+import threading
+
+
+# Spending limit of one question: model calls and input/output tokens, 0 meaning unlimited.
+# ask_model(..., budget=) charges every call that reaches the model (cache hits are free). The pipeline
+# checks exhausted() before optional work such as retries, re-prompts and further rounds, so a question
+# that hits its budget still finishes the round it is in and is scored from what was collected.
+
+class Budget:
+
+    def __init__(self, max_calls=0, max_input_tokens=0, max_output_tokens=0):
+        self.max_calls = max_calls
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.hit = False
+        self._lock = threading.Lock()
+
+    def charge(self, input_tokens, output_tokens):
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+
+    def exhausted(self):
+        with self._lock:
+            exhausted = ((self.max_calls and self.calls >= self.max_calls)
+                         or (self.max_input_tokens and self.input_tokens >= self.max_input_tokens)
+                         or (self.max_output_tokens and self.output_tokens >= self.max_output_tokens))
+            # remember that some work was skipped because of the budget
+            if exhausted:
+                self.hit = True
+            return bool(exhausted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "max_calls": self.max_calls,
+                "max_input_tokens": self.max_input_tokens,
+                "max_output_tokens": self.max_output_tokens,
+                "hit": self.hit,
+            }
+
+    def restore(self, stats):
+        with self._lock:
+            self.calls = stats["calls"]
+            self.input_tokens = stats["input_tokens"]
+            self.output_tokens = stats["output_tokens"]
+            self.hit = stats["hit"]
+
+
+def add_budget_args(parser):
+    parser.add_argument("--max_calls_per_question", type=int, default=0, help="model call budget per question, 0 for no limit")
+    parser.add_argument("--max_input_tokens_per_question", type=int, default=0, help="input token budget per question, 0 for no limit")
+    parser.add_argument("--max_output_tokens_per_question", type=int, default=0, help="output token budget per question, 0 for no limit")
+    return parser
+
+
+def budget_from_args(args):
+    return Budget(args.max_calls_per_question, args.max_input_tokens_per_question, args.max_output_tokens_per_question)
@@ -0,0 +1,92 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+# Persistent cache of model responses keyed by the full request, shared by all stages and reruns.
+# SQLite keeps it a single file that several processes (e.g. --start/--end shards) can use at once.
+
+def hash_messages(messages, key=None):
+    # continues a copy of key, e.g. the hash state of a PromptPrefix, with messages
+    key = hashlib.sha256() if key is None else key.copy()
+    for message in messages:
+        key.update(json.dumps([message["role"], message["content"]]).encode())
+        key.update(b'\n')
+    return key
+
+
+def cache_key(messages, modelId, use_temp, top_p, max_token):
+    # messages are hashed first and one at a time, so a shared message prefix yields a shared hash state
+    prefix = getattr(messages, 'prefix', None)
+    if prefix is not None and prefix.matches(messages):
+        key = hash_messages(messages[len(prefix):], prefix.key_state)
+    else:
+        key = hash_messages(messages)
+    key.update(json.dumps([modelId, use_temp, top_p, max_token]).encode())
+    return key.hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, path, max_entries=1000000, read_only=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if read_only:
+            self.conn = sqlite3.connect('file:' + path + '?mode=ro', uri=True, timeout=60, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        if self.read_only or response is None:
+            return
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                              (key, response, time.time()))
+            self.num_entries += 1
+            if self.num_entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # drop the least recently used entries down to 90% of the limit, so eviction runs once per many inserts
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = self.num_entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                              (excess,))
+            self.num_entries -= excess
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.num_entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,172 @@
+import json
+import time
+import threading
+import contextvars
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+
+
+# In-process record of every ask_model call: call-site tag, latency, sizes, retries and cache hits,
+# attributed to the question and agent it was made for. Disabled unless --metrics or --trace_path is given.
+
+CallRecord = namedtuple('CallRecord', ['tag', 'start', 'latency', 'input_chars', 'output_chars', 'input_tokens',
+                                       'output_tokens', 'retries', 'cache_hit', 'context', 'thread'])
+
+# fields such as question and agent describing what the current call is made for
+_call_context = contextvars.ContextVar('llm_call_context', default=dict())
+
+
+def estimate_tokens(text):
+    # roughly four characters per token, for backends that do not report usage
+    return max(1, round(len(text) / 4))
+
+
+def count_tokens(messages, response, usage=None):
+    # token usage reported by the backend, estimated where it reports none
+    usage = usage or dict()
+    input_tokens = usage.get('input_tokens') or sum(estimate_tokens(message["content"]) for message in messages)
+    output_tokens = usage.get('output_tokens') or (estimate_tokens(response) if response else 0)
+    return input_tokens, output_tokens
+
+
+@contextmanager
+def call_context(**fields):
+    token = _call_context.set({**_call_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+
+def set_call_context(**fields):
+    # for serial loops, where each item simply replaces the previous item's fields
+    _call_context.set({**_call_context.get(), **fields})
+
+
+def with_context(fn, **fields):
+    # Context variables do not follow work into executor threads, so wrap fn to run in a copy of the
+    # caller's context (plus fields) wherever it is executed. Every call gets its own copy, so the
+    # wrapper can run in several threads at once.
+    context = contextvars.copy_context()
+
+    def call(*args, **kwargs):
+        if fields:
+            _call_context.set({**_call_context.get(), **fields})
+        return fn(*args, **kwargs)
+
+    def run(*args, **kwargs):
+        return context.copy().run(call, *args, **kwargs)
+    return run
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, tag, messages, response, start, usage=None, cache_hit=False):
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        input_chars = sum(len(message["content"]) for message in messages)
+        output_chars = len(response) if response is not None else 0
+        input_tokens, output_tokens = count_tokens(messages, response, usage)
+        usage = usage or dict()
+        record = CallRecord(
+            tag=tag or 'untagged',
+            start=start - self.origin,
+            latency=end - start,
+            input_chars=input_chars,
+            output_chars=output_chars,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            retries=usage.get('retries', 0),
+            cache_hit=cache_hit,
+            context=_call_context.get(),
+            thread=threading.get_ident(),
+        )
+        with self._lock:
+            self.records.append(record)
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+            self.origin = time.perf_counter()
+
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+        by_tag = dict()
+        for record in records:
+            by_tag.setdefault(record.tag, []).append(record)
+
+        summary = dict()
+        for tag, tag_records in by_tag.items():
+            latencies = np.array([record.latency for record in tag_records if not record.cache_hit])
+            summary[tag] = {
+                "calls": len(tag_records),
+                "cache_hits": sum(record.cache_hit for record in tag_records),
+                "retries": sum(record.retries for record in tag_records),
+                "total_latency_s": round(float(latencies.sum()), 3) if len(latencies) else 0.0,
+                "p50_latency_s": round(float(np.percentile(latencies, 50)), 4) if len(latencies) else 0.0,
+                "p95_latency_s": round(float(np.percentile(latencies, 95)), 4) if len(latencies) else 0.0,
+                "input_chars": sum(record.input_chars for record in tag_records),
+                "output_chars": sum(record.output_chars for record in tag_records),
+                "input_tokens": sum(record.input_tokens for record in tag_records),
+                "output_tokens": sum(record.output_tokens for record in tag_records),
+            }
+        # most expensive call sites first
+        return dict(sorted(summary.items(), key=lambda item: item[1]["total_latency_s"], reverse=True))
+
+    def format_summary(self):
+        columns = ["calls", "cache_hits", "retries", "total_latency_s", "p50_latency_s", "p95_latency_s",
+                   "input_tokens", "output_tokens"]
+        summary = self.summary()
+        width = max([len('tag')] + [len(tag) for tag in summary])
+        lines = ['tag'.ljust(width) + ''.join(column.rjust(16) for column in columns)]
+        for tag, row in summary.items():
+            lines.append(tag.ljust(width) + ''.join(str(row[column]).rjust(16) for column in columns))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        # One process per question and one thread per agent, so chrome://tracing or Perfetto shows
+        # the timeline of every question's calls with a lane per agent.
+        with self._lock:
+            records = list(self.records)
+        processes = dict()
+        threads = dict()
+        events = []
+        for record in records:
+            question = record.context.get('question', 'none')
+            agent = record.context.get('agent', 'pipeline')
+            pid = processes.setdefault(question, len(processes))
+            if (pid, agent) not in threads:
+                threads[(pid, agent)] = len([key for key in threads if key[0] == pid])
+            tid = threads[(pid, agent)]
+            events.append({
+                "name": record.tag,
+                "cat": "cache" if record.cache_hit else "llm",
+                "ph": "X",
+                "ts": round(record.start * 1e6),
+                "dur": round(record.latency * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": {key: value for key, value in record._asdict().items() if key not in ('start', 'latency', 'context', 'tag')},
+            })
+        for question, pid in processes.items():
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "question " + str(question)}})
+        for (pid, agent), tid in threads.items():
+            name = agent if agent == 'pipeline' else "agent " + str(agent)
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        json.dump(self.chrome_trace(), open(path, "w"))
+        return path
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,238 @@
+import re
+import json
+import time
+import random
+import threading
+from .llm_cache import cache_key
+from .unknown_detection import uncertainty_pattern
+from .llm_metrics import estimate_tokens
+
+
+# Offline stand-in for Bedrock, selected with --backend mock. It recognises the prompt families of this repo by
+# their system prompt and returns well-formed responses in the format each caller parses, so every pipeline runs
+# end to end without network access. Responses are a pure function of (seed, request, repeat number):
+# a rerun with the same seed replays the same answers, while repeated sampled requests (e.g. self-consistency
+# samples at temperature 0.7) still differ from each other.
+
+ANSWERS = ["Paris", "London", "Berlin", "Madrid", "Rome"]
+ANSWER_WEIGHTS = [0.5, 0.25, 0.12, 0.08, 0.05]
+
+ASPECTS = ["historical background", "geographical context", "cultural significance", "notable figures",
+           "economic impact", "scientific facts", "political context", "public perception"]
+
+PARAPHRASES = ["Can you tell me, ", "I would like to know, ", "Quick question, ", "Do you know, ", "Please answer, "]
+
+
+def _normalize(text):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+
+def _last_user(messages, startswith=''):
+    for message in reversed(messages):
+        if message["role"] == "user" and message["content"].strip().startswith(startswith):
+            return message["content"].strip()
+    return ''
+
+
+def _last_assistant(messages):
+    for message in reversed(messages):
+        if message["role"] == "assistant":
+            return message["content"]
+    return ''
+
+
+def _group(answers):
+    # answers with the same normalized text form one group, keyed by the first of them
+    groups = dict()
+    keys = dict()
+    for number, answer in answers:
+        normalized = _normalize(answer)
+        if normalized not in keys:
+            keys[normalized] = answer
+            groups[answer] = []
+        groups[keys[normalized]].append(number)
+    return groups
+
+
+class MockBackend:
+
+    # prompt families whose callers retry on unparseable output; failure_rate only applies to these
+    FAILING_FAMILIES = ("consistency", "equivalence", "semantic_check", "extraction")
+
+    def __init__(self, seed=0, latency=0.0, token_latency=0.0, failure_rate=0.0, unknown_rate=0.1, switch_rate=0.3):
+        self.seed = seed
+        self.latency = latency
+        self.token_latency = token_latency
+        self.failure_rate = failure_rate
+        self.unknown_rate = unknown_rate
+        self.switch_rate = switch_rate
+        self.num_calls = 0
+        self.num_failures = 0
+        self.family_counts = dict()
+        self._repeats = dict()
+        self._lock = threading.Lock()
+
+    def family(self, messages):
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ''
+        if 'semantic equivalence of the keys' in system:
+            return "equivalence"
+        if 'identify unique answers' in system:
+            return "consistency"
+        if 'Guess:' in system:
+            return "semantic_check"
+        if 'indicates uncertainty' in system:
+            return "unknown"
+        if 'extract the complete answer' in system or 'extract the answer to the given question' in system:
+            return "extraction"
+        if 'helps people answer questions' in system:
+            return "answer"
+        if 'broader category' in system:
+            return "conceptualization"
+        if 'numbered line' in system:
+            return "topic_fused"
+        if 'order the aspects' in system:
+            return "topic_ordering"
+        if 'key conceptual aspects' in system:
+            return "topic_sampling"
+        if 'Examine whether specific knowledge' in system:
+            return "question_necessity"
+        if 'Using only the information from each subsequent question' in system:
+            return "question_answer"
+        if 'Generate 5 questions' in system:
+            return "question_generation"
+        if 'semantically equivalent questions' in system:
+            return "semantic_questions"
+        return "other"
+
+    def _rng(self, messages, max_token, use_temp, top_p, modelId):
+        key = cache_key(messages, modelId, use_temp, top_p, max_token)
+        with self._lock:
+            repeat = self._repeats.get(key, 0)
+            self._repeats[key] = repeat + 1
+        return random.Random(f'{self.seed}:{key}:{repeat}')
+
+    def invoke(self, messages, max_token=256, use_temp=1, top_p=1, modelId=''):
+        rng = self._rng(messages, max_token, use_temp, top_p, modelId)
+        family = self.family(messages)
+        if family in self.FAILING_FAMILIES and rng.random() < self.failure_rate:
+            response = self.malformed(family, messages)
+            failed = True
+        else:
+            response = getattr(self, 'respond_' + family)(messages, rng)
+            failed = False
+
+        with self._lock:
+            self.num_calls += 1
+            self.num_failures += failed
+            self.family_counts[family] = self.family_counts.get(family, 0) + 1
+
+        delay = self.latency + self.token_latency * estimate_tokens(response)
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.num_calls, "failures": self.num_failures, "families": dict(self.family_counts)}
+
+    def malformed(self, family, messages):
+        if family in ("consistency", "equivalence"):
+            # JSON with single quotes, which the callers cannot decode and ask to regenerate
+            return getattr(self, 'respond_' + family)(messages, None).replace('"', "'")
+        if family == "semantic_check":
+            return "Yes"
+        return "The answer cannot be extracted."
+
+    def respond_answer(self, messages, rng):
+        previous = _last_assistant(messages)
+        mentioned = re.search(r'You mentioned that (.*) Which is your actual answer', _last_user(messages), re.S)
+        if previous and mentioned:
+            # an interaction round: keep the previous answer or adopt the one from the other agent
+            if rng.random() < self.switch_rate and not uncertainty_pattern.search(mentioned.group(1)):
+                for answer in ANSWERS:
+                    if answer in mentioned.group(1):
+                        return f"The answer is {answer}."
+            return previous
+        if rng.random() < self.unknown_rate:
+            return "I don't know the answer to that question."
+        return f"The answer is {rng.choices(ANSWERS, ANSWER_WEIGHTS)[0]}."
+
+    def respond_extraction(self, messages, rng):
+        response = _last_user(messages, 'Response:')[len('Response:'):]
+        response = response.split('\nBased solely on the response')[0].strip()
+        if response == '' or uncertainty_pattern.search(response):
+            return "I don't know the answer."
+        return response.split('. ')[0].rstrip('.') + '.'
+
+    def respond_unknown(self, messages, rng):
+        answer = _last_user(messages)
+        if uncertainty_pattern.search(answer):
+            return "I don't know"
+        return answer
+
+    def respond_semantic_check(self, messages, rng):
+        prompt = _last_user(messages, 'Question:')
+        gold = re.search(r'\nGold answer: (.*)\nGenerated answer: ', prompt, re.S)
+        generated = prompt.split('\nGenerated answer: ')[-1]
+        same = gold is not None and _normalize(gold.group(1)) in _normalize(generated)
+        return f"Guess: {'Yes' if same else 'No'}\nProbability: {rng.uniform(0.6, 0.95):.2f}"
+
+    def respond_consistency(self, messages, rng):
+        prompt = _last_user(messages, 'Question:')
+        answers = [(int(match.group(1)), match.group(2)) for match in re.finditer(r'^(\d+)\. (.*)$', prompt, re.M)]
+        return json.dumps(_group(answers))
+
+    def respond_equivalence(self, messages, rng):
+        prompt = _last_user(messages, 'Question:')
+        try:
+            json_data = json.loads(prompt.split('Json: ', 1)[1])
+        except (IndexError, json.JSONDecodeError):
+            return "{}"
+        answers = [(number, key) for key, numbers in json_data.items() for number in numbers]
+        return json.dumps(_group(answers))
+
+    def respond_conceptualization(self, messages, rng):
+        return _last_user(messages)
+
+    def respond_topic_sampling(self, messages, rng):
+        return '\n'.join(rng.sample(ASPECTS, 5))
+
+    def respond_topic_ordering(self, messages, rng):
+        aspects = _last_user(messages).split('Aspects to Consider: ', 1)[-1].strip().split('\n')
+        rng.shuffle(aspects)
+        return '\n'.join(aspects)
+
+    def respond_topic_fused(self, messages, rng):
+        return '\n'.join(f'{i + 1}. {aspect}' for i, aspect in enumerate(rng.sample(ASPECTS, 5)))
+
+    def _judge(self, messages, rng, yes_rate):
+        questions = re.findall(r'^Q(\d+): ', _last_user(messages), re.M)
+        lines = []
+        for number in questions:
+            lines.append(f"Q{number} Explanation: the question refers to the given question.")
+            lines.append(f"Q{number} Judge: {'Yes' if rng.random() < yes_rate else 'No'}")
+        return '\n'.join(lines)
+
+    def respond_question_necessity(self, messages, rng):
+        return self._judge(messages, rng, 0.7)
+
+    def respond_question_answer(self, messages, rng):
+        return self._judge(messages, rng, 0.2)
+
+    def respond_question_generation(self, messages, rng):
+        prompt = _last_user(messages, 'Question:')
+        question = prompt[len('Question: '):].split('\nAspect: ')[0].rstrip('?')
+        question = question[:1].lower() + question[1:]
+        aspect = prompt.split('\nAspect: ')[-1]
+        # no ": " inside the questions, the callers split each line on it
+        templates = ["How does {} relate to {}?", "What role does {} play in {}?", "Why is {} important for {}?",
+                     "How has {} shaped {}?", "What does {} tell us about {}?"]
+        return '\n'.join(f'Q{i + 1}: ' + template.format(aspect, question) for i, template in enumerate(templates))
+
+    def respond_semantic_questions(self, messages, rng):
+        question = _last_user(messages)
+        question = question[:1].lower() + question[1:]
+        return '\n'.join(prefix + question for prefix in PARAPHRASES)
+
+    def respond_other(self, messages, rng):
+        return "OK"
@@ -0,0 +1,53 @@
+import copy
+from .llm_cache import hash_messages
+from .utils import llama_prompt, claude_messages
+
+
+# A fixed few-shot message list that many calls start with. It is serialized once per process (Llama prompt
+# string, Claude turns, cache key hash state); each call takes a fresh list of the prefix messages with copy()
+# and appends its own turns, and build_request_body / cache_key only process what follows the prefix.
+
+class PrefixedMessages(list):
+    # a plain list of messages that remembers the PromptPrefix it starts with
+
+    def __init__(self, messages, prefix):
+        super().__init__(messages)
+        self.prefix = prefix
+
+
+class PromptPrefix:
+
+    def __init__(self, messages):
+        self.messages = tuple(dict(message) for message in messages)
+        self.llama_prompt = llama_prompt(self.messages)
+        self.claude_system, turns = claude_messages(self.messages)
+        self.key_state = hash_messages(self.messages)
+
+        self._claude_turns = tuple(turns)
+        # the same turns with a cache breakpoint on the last block, which caches the system prompt and all turns
+        cached_turns = copy.deepcopy(turns)
+        if cached_turns:
+            cached_turns[-1]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+        self._claude_cached_turns = tuple(cached_turns)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def copy(self):
+        # fresh copies of the prefix messages, so callers may append to or edit the returned list freely
+        return PrefixedMessages([dict(message) for message in self.messages], self)
+
+    def matches(self, messages):
+        # false once a caller changed or removed any of the prefix messages
+        if len(messages) < len(self.messages):
+            return False
+        for message, prefix_message in zip(messages, self.messages):
+            if message["role"] != prefix_message["role"]:
+                return False
+            # the content strings are normally the prefix's own objects, so the comparison is an identity check
+            if message["content"] is not prefix_message["content"] and message["content"] != prefix_message["content"]:
+                return False
+        return True
+
+    def claude_messages(self, prompt_caching=False):
+        return list(self._claude_cached_turns if prompt_caching else self._claude_turns)
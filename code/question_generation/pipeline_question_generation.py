@@ -1,8 +1,13 @@
+import re
 import json
 import argparse
 from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import time
-from ..utils import ask_model
+from ..utils import ask_model, add_model_args, configure_model
+from ..result_io import open_results, add_result_args
+from ..llm_metrics import call_context, with_context
 
 class Pipeline:
 
@@ -10,6 +15,8 @@ class Pipeline:
         self.modelId = args.model_name
         self.num_agents = args.num_agents
         self.conceptualized_question = args.conceptualized_question
+        self.parallel_aspects = args.parallel_aspects
+        self.fused_topic = args.fused_topic
 
 
     def question_conceptualization(self,question):
@@ -94,6 +101,40 @@ class Pipeline:
         return topic, response
 
 
+    def topic_sampling_ordered(self, question):
+        # topic_sampling and topic_ordering in a single request; returns None if the list cannot be parsed
+        message = [
+            {
+                "role": "system",
+                "content": """Can you identify up to 5 key conceptual aspects that are as varied and diverse as possible, ensuring a comprehensive and multifaceted understanding of the question?
+                The aspect SHOUlD NOT indicate the answer to the question.
+                Then order the aspects based on how likely people are to ask follow-up questions about each, starting with the most likely. Consider the direct relevance of each aspect to the original question, the complexity and scope of the information each might contain, and general public interest.
+                Given ONLY the ordered aspect names, no other words or explanation.
+                STRICTLY follow the format that each aspect is a numbered line: <rank>. <aspect name, as short as possible; not a complete sentence!>"""
+            },
+            {
+                "role": "user",
+                "content": "What is the most spoken language in the world?"
+            },
+            {
+                "role": "assistant",
+                "content": "1. demographic statistics\n2. cultural influence\n3. globalization effects\n4. technology and media\n5. education policy"
+            },
+        ]
+
+        message.append({"role": "user", "content": question})
+        response = ask_model(message, use_temp=0.7, modelId=self.modelId)
+
+        topic = []
+        for line in response.replace('<','').replace('>','').split('\n'):
+            match = re.match(r'\s*\d+\s*[.):]\s*(.+)', line)
+            if match:
+                topic.append(match.group(1).strip())
+        if len(topic) == 0:
+            return None
+        return topic, response
+
+
     def check_question_content_necessity(self, question, generated_questions):
 
         message = [
@@ -266,6 +307,17 @@ class Pipeline:
         return response.replace('\n\n', '\n').split('\n'), response
 
 
+    def sample_ordered_topics(self, question):
+        if self.fused_topic:
+            fused = self.topic_sampling_ordered(question)
+            if fused is not None:
+                aspects, response = fused
+                return aspects, response, response
+        aspects, aspects_response = self.topic_sampling(question)
+        aspects, ordered_response = self.topic_ordering(question, aspects)
+        return aspects, aspects_response, ordered_response
+
+
     def run(self, question, gold_answer):
         print(question)
         print(gold_answer)
@@ -277,11 +329,9 @@ class Pipeline:
         if self.conceptualized_question:
             concept_question = self.question_conceptualization(question)
             obj['conceptualized_question'] = concept_question
-            aspects, aspects_response = self.topic_sampling(concept_question)
-            aspects, ordered_response = self.topic_ordering(concept_question, aspects)
+            aspects, aspects_response, ordered_response = self.sample_ordered_topics(concept_question)
         else:
-            aspects, aspects_response = self.topic_sampling(question)
-            aspects, ordered_response = self.topic_ordering(question, aspects)
+            aspects, aspects_response, ordered_response = self.sample_ordered_topics(question)
 
         final_questions = []
         question_generation_log = defaultdict(list)
@@ -293,13 +343,23 @@ class Pipeline:
 
 
 
-        for aspect in aspects:
-            questions, questions_log = self.generic_topic_question(question,aspect)
+        if self.parallel_aspects:
+            # the aspects are independent, so generate all of them and the semantically equivalent questions at once
+            with ThreadPoolExecutor(max_workers=len(aspects) + 1) as executor:
+                semantic_future = executor.submit(with_context(self.generate_semantically_equivalent_question), question)
+                aspect_results = list(executor.map(with_context(partial(self.generic_topic_question, question)), aspects))
+                semantic_result = semantic_future.result()
+        else:
+            aspect_results = [self.generic_topic_question(question, aspect) for aspect in aspects]
+            semantic_result = self.generate_semantically_equivalent_question(question)
+
+        # merged in the original aspect order
+        for aspect, (questions, questions_log) in zip(aspects, aspect_results):
             question_generation_log[aspect + '_question_generation'] = [questions, questions_log]
             final_questions += questions
             obj['aspect_questions'][aspect] = questions
 
-        semantically_equivalent_questions, response =  self.generate_semantically_equivalent_question(question)
+        semantically_equivalent_questions, response = semantic_result
         question_generation_log['semantic_question_generation'] =[semantically_equivalent_questions, question, response]
         final_questions += semantically_equivalent_questions
         obj['aspect_questions']['semantic_question_generation'] = semantically_equivalent_questions
@@ -322,6 +382,10 @@ def parse_args():
     parser.add_argument("--end", type=int, default=10000, help="training epoch")
     parser.add_argument("--num_agents", type=int, default=5, help="num_agents")
     parser.add_argument("--conceptualized_question", type=bool, default=True, help="conceptualized_question")
+    parser.add_argument("--parallel_aspects", action="store_true", help="generate the questions of all aspects concurrently")
+    parser.add_argument("--fused_topic", action="store_true", help="sample and order the aspects in a single request")
+    add_model_args(parser)
+    add_result_args(parser)
 
 
     args = parser.parse_args()
@@ -330,6 +394,7 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
     pipe = Pipeline(args)
 
@@ -337,23 +402,24 @@ def main():
     with open( args.file_dic + "/data/" + args.dataset_name + ".json") as f:
         df_all = json.load(f)
 
-    out_objs = []
+    writer, completed = open_results(args.file_dic + "/result/question_generation/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json", args.resume)
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
 
         print(i)
         question = df['question']
         gold_answer = df['gold_answer']
-        obj = pipe.run(question, gold_answer)
-        out_objs.append(obj)
+        with call_context(question=i):
+            obj = pipe.run(question, gold_answer)
+        obj['id'] = i
+        writer.write(obj)
         print(obj['aspect_questions'])
         print('\n')
 
-        json.dump(out_objs, open(
-            args.file_dic + "/result/question_generation/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json",
-            "w"), indent=4)
+    writer.close()
 
 if __name__ == '__main__':
 	main()
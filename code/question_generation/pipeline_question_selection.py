@@ -1,12 +1,62 @@
 
-import json
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import random
-from sentence_transformers import SentenceTransformer, util
 import time
-model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-from ..utils import ask_model
+from ..utils import ask_model, add_model_args, configure_model
+from ..embedding import get_embedding_service, DEFAULT_EMBEDDING_MODEL
+from ..unknown_detection import check_unknown, unknown_stats
+from ..result_io import open_results, read_results, add_result_args
+from ..llm_metrics import call_context, with_context
+from ..prompt_prefix import PromptPrefix
+
+
+# few-shot prefix of extract_atomic_fact_answer
+extraction_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": """Can you extract the answer to the given question using ONLY the information from the response? Please identify the answer directly and do not use your parametric knowledge. If the response includes a negation to the question, uses those as the answer. If you cannot extract the answer, you must only respond with "The answer cannot be explicitly extracted"."""
+    },
+    {
+        "role": "user",
+        "content": """Response: The prevalence of the most spoken language in the world, which is Mandarin Chinese, has a significant influence on global media and entertainment in several ways:
+
+                1. **Content creation**: Many Chinese production companies and studios create content specifically for the massive Chinese-speaking audience, which often gets distributed globally. This leads to a increase in Chinese-language content in international markets.
+                2. **Dubbing and subtitles**: To cater to the large Chinese-speaking population, many international films and TV shows are dubbed or subtitled in Mandarin, making them more accessible to Chinese audiences.
+                3. **Global market appeal**: The massive Chinese market has become a crucial factor in the success of global films, TV shows, and music. Creators often tailor their content to appeal to Chinese audiences, incorporating Chinese themes, actors, or storylines.
+                4. **Influence on global trends**: Chinese social media platforms, such as WeChat and Weibo, have become essential channels for promoting global entertainment content. Trends and memes that originate in China can quickly spread globally.
+                5. **Cultural exchange**: The prevalence of Mandarin Chinese has facilitated cultural exchange between China and other countries. International artists and creators are increasingly collaborating with Chinese counterparts, leading to a fusion of cultural influences in media and entertainment.
+
+                Overall, the dominance of Mandarin Chinese has reshaped the global media and entertainment landscape, with creators and distributors adapting to cater to the vast and influential Chinese-speaking audience.
+                Based solely on the response, What is the most spoken language in the world?"""
+    },
+    {
+        "role": "assistant",
+        "content": "The most spoken language in the world is Mandarin Chinese."
+    },
+    {
+        "role": "user",
+        "content": """Response: There is no evidence of an animal landing on the moon. The first humans to walk on the moon were Neil Armstrong and Edwin "Buzz" Aldrin during the Apollo 11 mission in 1969. However, animals have been launched into space as part of space research and exploration.
+                One example is Laika, a Soviet space dog who became the first living creature to orbit the Earth in 1957. Laika's mission, Sputnik 2, provided valuable data on the safety and feasibility of space travel for living organisms. Although Laika did not survive the flight, the mission helped scientists understand the effects of space travel on a living organism's physiology and paved the way for future human spaceflight.
+                Other animals, such as fruit flies, worms, and mice, have also been sent to space as part of scientific experiments to study the effects of microgravity and space radiation on living organisms. These experiments have contributed significantly to our understanding of space travel's effects on living organisms and have helped inform the development of safety measures for human space travelers.
+                Based solely on the response, What is the name of the first animal to land on the moon?"""
+    },
+    {
+        "role": "assistant",
+        "content": "There is no evidence of an animal landing on the moon."
+    },
+    {
+        "role": "user",
+        "content": """Response: If you traveled to most countries in the world, you would be most likely to encounter English. English is widely spoken and has become a lingua franca, meaning it's often used as a common language for international communication. It's an official language in over 60 countries and is widely spoken in many more.
+                Based solely on the response, What is the most spoken language in the world?"""
+    },
+    {
+        "role": "assistant",
+        "content": "The answer cannot be explicitly extracted."
+    },
+
+])
 
 
 class Pipeline:
@@ -15,6 +65,8 @@ class Pipeline:
         self.modelId = args.model_name
         self.num_agents = args.num_agents
         self.conceptualized_question = args.conceptualized_question
+        self.embedding_service = get_embedding_service(args.embedding_model, args.embedding_cache_dir)
+        self.probe_width = args.probe_width
 
     def generate_semantically_equivalent_question(self, question):
         message = [
@@ -46,50 +98,7 @@ class Pipeline:
     def extract_atomic_fact_answer(self, response, question):
         # other way based solely on your response method
 
-        message = [
-            {
-                "role": "system",
-                "content": """Can you extract the answer to the given question using ONLY the information from the response? Please identify the answer directly and do not use your parametric knowledge. If the response includes a negation to the question, uses those as the answer. If you cannot extract the answer, you must only respond with "The answer cannot be explicitly extracted"."""
-            },
-            {
-                "role": "user",
-                "content": """Response: The prevalence of the most spoken language in the world, which is Mandarin Chinese, has a significant influence on global media and entertainment in several ways:
-
-                1. **Content creation**: Many Chinese production companies and studios create content specifically for the massive Chinese-speaking audience, which often gets distributed globally. This leads to a increase in Chinese-language content in international markets.
-                2. **Dubbing and subtitles**: To cater to the large Chinese-speaking population, many international films and TV shows are dubbed or subtitled in Mandarin, making them more accessible to Chinese audiences.
-                3. **Global market appeal**: The massive Chinese market has become a crucial factor in the success of global films, TV shows, and music. Creators often tailor their content to appeal to Chinese audiences, incorporating Chinese themes, actors, or storylines.
-                4. **Influence on global trends**: Chinese social media platforms, such as WeChat and Weibo, have become essential channels for promoting global entertainment content. Trends and memes that originate in China can quickly spread globally.
-                5. **Cultural exchange**: The prevalence of Mandarin Chinese has facilitated cultural exchange between China and other countries. International artists and creators are increasingly collaborating with Chinese counterparts, leading to a fusion of cultural influences in media and entertainment.
-
-                Overall, the dominance of Mandarin Chinese has reshaped the global media and entertainment landscape, with creators and distributors adapting to cater to the vast and influential Chinese-speaking audience.
-                Based solely on the response, What is the most spoken language in the world?"""
-            },
-            {
-                "role": "assistant",
-                "content": "The most spoken language in the world is Mandarin Chinese."
-            },
-            {
-                "role": "user",
-                "content": """Response: There is no evidence of an animal landing on the moon. The first humans to walk on the moon were Neil Armstrong and Edwin "Buzz" Aldrin during the Apollo 11 mission in 1969. However, animals have been launched into space as part of space research and exploration.
-                One example is Laika, a Soviet space dog who became the first living creature to orbit the Earth in 1957. Laika's mission, Sputnik 2, provided valuable data on the safety and feasibility of space travel for living organisms. Although Laika did not survive the flight, the mission helped scientists understand the effects of space travel on a living organism's physiology and paved the way for future human spaceflight.
-                Other animals, such as fruit flies, worms, and mice, have also been sent to space as part of scientific experiments to study the effects of microgravity and space radiation on living organisms. These experiments have contributed significantly to our understanding of space travel's effects on living organisms and have helped inform the development of safety measures for human space travelers.
-                Based solely on the response, What is the name of the first animal to land on the moon?"""
-            },
-            {
-                "role": "assistant",
-                "content": "There is no evidence of an animal landing on the moon."
-            },
-            {
-                "role": "user",
-                "content": """Response: If you traveled to most countries in the world, you would be most likely to encounter English. English is widely spoken and has become a lingua franca, meaning it's often used as a common language for international communication. It's an official language in over 60 countries and is widely spoken in many more.
-                Based solely on the response, What is the most spoken language in the world?"""
-            },
-            {
-                "role": "assistant",
-                "content": "The answer cannot be explicitly extracted."
-            },
-
-        ]
+        message = extraction_prompt.copy()
 
         prompt = 'Response: ' + response + '\nBased solely on the response, ' + question
 
@@ -100,61 +109,7 @@ class Pipeline:
 
 
     def check_unknown(self,answer):
-
-
-        # if we have a new model, use this prompt, otherwise for claude3 and llama3, the uncertainty phrases are more accuate.
-
-        message = [
-            {
-                "role": "system",
-                "content": """Evaluate the model's response to determine if it indicates uncertainty. Use the following steps:
-                1. Check if the response contains any phrases from a predefined list of "uncertainty phrases" or similar expressions. These phrases indicate that the model does not know the answer.
-                2. If any uncertainty phrase or similar expressions is present, return "I don't know".
-                3. If no uncertainty phrase is present, return the original response exactly as is, without any changes or added explanation.
-
-                Uncertainty phrases include:
-                [
-                    "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
-                    "is not definitively known", "is uncertain", "does not mention", "there is no information",
-                    "does not provide", "there is not enough information provided to determine", "cannot be determined",
-                    "is not provided", "is not known", "The response does not provide any information",
-                    "The response does not provide enough information", "There is no answer.", "is unclear",
-                    "remains uncertain",
-                    "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
-                    "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
-                    "there is no definitive",
-                    "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
-                    "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
-                    "you do not have enough verified information",
-                    "I don't have enough information", "I need more context", "I apologize, ",
-                    "The question cannot be answered", "no factual information", "not enough factual information",
-                    "does not have enough factual information", "does not actually have any factual information", "Unknown", 
-                    "couldn't find any information", "There is no information available", "There is no information",
-                    "There is not enough information", "I need more information to"
-                ]"""
-            },
-            {
-                "role": "user",
-                "content": "The response does not provide enough information to determine the answer.",
-            },
-            {
-                "role": "assistant",
-                "content": "I don't know"
-            },
-            {
-                "role": "user",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin.",
-            },
-            {
-                "role": "assistant",
-                "content": "It takes repeated uses over a short space of time to become physically addicted to heroin."
-            },
-        ]
-
-        message.append({"role": "user", "content": answer})
-        response = ask_model(message, use_temp=0.15, modelId=self.modelId)
-
-        return response
+        return check_unknown(answer, self.modelId)
 
 
 
@@ -181,14 +136,41 @@ class Pipeline:
             return False
 
 
+    def first_answerable_question(self, questions, original_question):
+
+        if self.probe_width <= 1:
+            for question in questions:
+                if self.check_question_answerability(question, original_question):
+                    return question
+            return None
+
+        # Speculatively probe the next probe_width candidates at once, but consume the results in order,
+        # so the chosen question is the first answerable one in shuffle order, as in the serial walk.
+        executor = ThreadPoolExecutor(max_workers=self.probe_width)
+        check_question_answerability = with_context(self.check_question_answerability)
+        try:
+            in_flight = deque()
+            remaining = deque(questions)
+            while remaining and len(in_flight) < self.probe_width:
+                question = remaining.popleft()
+                in_flight.append((question, executor.submit(check_question_answerability, question, original_question)))
+            while in_flight:
+                question, future = in_flight.popleft()
+                if future.result():
+                    return question
+                if remaining:
+                    next_question = remaining.popleft()
+                    in_flight.append((next_question, executor.submit(check_question_answerability, next_question, original_question)))
+            return None
+        finally:
+            # pending probes are cancelled; ones already running finish in the background and are ignored
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
     def question_reorder(self, origin_question, questions):
         similarity_score_dict = dict()
-        scores = []
-        for q in questions:
-            embedding_1 = model.encode(origin_question, convert_to_tensor=True)
-            embedding_2 = model.encode(q, convert_to_tensor=True)
-            score = util.pytorch_cos_sim(embedding_1, embedding_2).tolist()[0][0]
-            scores.append(score)
+        # the original question and all candidates are encoded in a single batch
+        scores = self.embedding_service.similarity(origin_question, questions)
 
         paired_list = list(zip(questions, scores))
         sorted_pairs = sorted(paired_list, key=lambda x: x[1], reverse=True)
@@ -229,11 +211,10 @@ class Pipeline:
             if category != "semantic_question_generation":
                 questions_to_check = questions[:]
                 random.shuffle(questions_to_check)
-                for question in questions_to_check:
-                    if self.check_question_answerability(question, original_question):
-                        final_question.append(question)
-                        final_question_category[question] = category
-                        break
+                question = self.first_answerable_question(questions_to_check, original_question)
+                if question is not None:
+                    final_question.append(question)
+                    final_question_category[question] = category
 
         if len(final_question) < self.num_agents:
             remain_question_num = self.num_agents - len(final_question)
@@ -292,6 +273,11 @@ def parse_args():
     parser.add_argument("--end", type=int, default=10000, help="training epoch")
     parser.add_argument("--num_agents", type=int, default=5, help="num_agents")
     parser.add_argument("--conceptualized_question", type=bool, default=True, help="conceptualized_question")
+    parser.add_argument("--embedding_model", type=str, default=DEFAULT_EMBEDDING_MODEL, help="sentence embedding model for question reordering")
+    parser.add_argument("--probe_width", type=int, default=1, help="candidate questions per category checked for answerability at once")
+    parser.add_argument("--embedding_cache_dir", type=str, default=None, help="directory of the persistent embedding store")
+    add_model_args(parser)
+    add_result_args(parser)
 
 
     args = parser.parse_args()
@@ -299,33 +285,35 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_model(args)
     print(args)
     pipe = Pipeline(args)
 
-    with open(args.file_dic + "/result/question_generation/" + args.dataset_name + "_question_generation_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json") as f:
-        df_all = json.load(f)
+    df_all = read_results(args.file_dic + "/result/question_generation/" + args.dataset_name + "_question_generation_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json")
 
 
-    out_objs = []
+    writer, completed = open_results(args.file_dic + "/result/question/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json", args.resume)
     for i, df in enumerate(df_all):
 
         if i >= args.end: break
         if i < args.start: continue
+        if i in completed: continue
 
         print(i)
         question = df['question']
         gold_answer = df['gold_answer']
         questions = df['aspect_questions']
-        obj = pipe.run(question, questions, gold_answer)
-        out_objs.append(obj)
+        with call_context(question=i):
+            obj = pipe.run(question, questions, gold_answer)
+        obj['id'] = i
+        writer.write(obj)
         print(obj['final_questions'])
         print('\n')
 
-
-
-        json.dump(out_objs, open(
-            args.file_dic + "/result/question/" + args.dataset_name + "_" + args.save_file +  "_"  + args.model_name.replace('/','-') +  "_"  + str(args.start) + ".json",
-            "w"), indent=4)
+    writer.close()
+    print('check_unknown: ', unknown_stats())
+    if pipe.embedding_service.stats() is not None:
+        print('Embedding store: ', pipe.embedding_service.stats())
 
 
 
@@ -0,0 +1,163 @@
+import re
+
+
+# Parsers for the structured parts of model responses. Each returns the parsed value or raises
+# ValueError, so they can be passed to utils.ask_with_retries.
+
+guess_pattern = re.compile(r'guess\s*:\s*([^\n]*)', re.IGNORECASE)
+
+
+def parse_guess(response):
+    # "Guess: Yes\nProbability: 0.8" -> "Yes"
+    match = guess_pattern.search(response or '')
+    if match is None or match.group(1).strip() == '':
+        raise ValueError('no "Guess:" line in the response')
+    return match.group(1).strip()
+
+
+# Clustering responses are meant to be a JSON object {"answer": [agent ids]}, but the model often wraps it
+# in a code fence or prose, uses single quotes, leaves trailing commas, quotes the ids or stops early.
+# The scanner below reads such text the way a person would, so only a response without any usable
+# mapping needs a new call.
+
+fence_pattern = re.compile(r'```[a-zA-Z]*')
+escapes = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '/': '/', '\\': '\\', '"': '"', "'": "'"}
+
+
+def _skip_space(text, i):
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return i
+
+
+def _closes_string(text, i):
+    # a quote ends the string only if what follows can follow a string, so "Poe's" stays one key
+    i = _skip_space(text, i)
+    return i >= len(text) or text[i] in ':,]}'
+
+
+def _scan_string(text, i):
+    quote = text[i]
+    chars = []
+    i += 1
+    while i < len(text):
+        char = text[i]
+        if char == '\\' and i + 1 < len(text):
+            if text[i + 1] == 'u' and i + 6 <= len(text):
+                try:
+                    chars.append(chr(int(text[i + 2:i + 6], 16)))
+                    i += 6
+                    continue
+                except ValueError:
+                    pass
+            chars.append(escapes.get(text[i + 1], text[i + 1]))
+            i += 2
+            continue
+        if char == quote and _closes_string(text, i + 1):
+            return ''.join(chars), i + 1
+        chars.append(char)
+        i += 1
+    # cut off in the middle of a string
+    return ''.join(chars), i
+
+
+def _scan_bare(text, i, stops):
+    start = i
+    while i < len(text) and text[i] not in stops:
+        i += 1
+    token = text[start:i].strip()
+    for convert in (int, float):
+        try:
+            return convert(token), i
+        except ValueError:
+            pass
+    return {'true': True, 'false': False, 'null': None}.get(token, token), i
+
+
+def _scan_value(text, i):
+    i = _skip_space(text, i)
+    if i >= len(text):
+        return None, i
+    if text[i] == '{':
+        return _scan_object(text, i + 1)
+    if text[i] == '[':
+        return _scan_list(text, i + 1)
+    if text[i] in '"\'':
+        return _scan_string(text, i)
+    return _scan_bare(text, i, ',]}\n')
+
+
+def _scan_object(text, i):
+    obj = dict()
+    while True:
+        i = _skip_space(text, i)
+        if i >= len(text):
+            return obj, i
+        if text[i] == '}':
+            return obj, i + 1
+        if text[i] == ',':
+            i += 1
+            continue
+        if text[i] in '"\'':
+            key, i = _scan_string(text, i)
+        else:
+            key, i = _scan_bare(text, i, ':}')
+            key = str(key)
+        i = _skip_space(text, i)
+        if i >= len(text) or text[i] != ':':
+            # a key without a value, e.g. the response was cut off
+            return obj, i
+        value, i = _scan_value(text, i + 1)
+        obj[key] = value
+
+
+def _scan_list(text, i):
+    items = []
+    while True:
+        i = _skip_space(text, i)
+        if i >= len(text):
+            return items, i
+        if text[i] == ']':
+            return items, i + 1
+        if text[i] == ',':
+            i += 1
+            continue
+        value, i = _scan_value(text, i)
+        items.append(value)
+        if i < len(text) and text[i] in '}\n' and not isinstance(value, (dict, list)):
+            # "[1, 2}" or a list left open at the end of a line
+            return items, i
+
+
+def _agent_ids(value):
+    # 3, 3.0, "3", "Answer 3" or "1, 2" -> agent ids
+    if isinstance(value, bool) or value is None:
+        return []
+    if isinstance(value, (int, float)):
+        return [int(value)] if value == int(value) and value > 0 else []
+    if isinstance(value, str):
+        return [int(digits) for digits in re.findall(r'\d+', value) if int(digits) > 0]
+    if isinstance(value, list):
+        return [agent_id for item in value for agent_id in _agent_ids(item)]
+    return []
+
+
+def parse_clusters(response):
+    # '```json\n{'Paris': ["1", 2,],}\n```' -> {"Paris": [1, 2]}
+    text = fence_pattern.sub('', response or '')
+    start = text.find('{')
+    if start == -1:
+        raise ValueError('no JSON object in the response')
+    obj, _ = _scan_object(text, start + 1)
+    # {"clusters": {...}} -> {...}
+    while len(obj) == 1 and isinstance(next(iter(obj.values())), dict):
+        obj = next(iter(obj.values()))
+
+    clusters = dict()
+    for key, value in obj.items():
+        agent_ids = _agent_ids(value)
+        if agent_ids:
+            clusters[key] = clusters.get(key, []) + agent_ids
+    if len(clusters) == 0:
+        raise ValueError('no answer groups in the response')
+    return clusters
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import threading
+
+
+# Results are streamed as JSON Lines: one record per line, appended as soon as it is produced,
+# instead of re-dumping the whole accumulated list after every item.
+
+def jsonl_path(path):
+    if path.endswith('.jsonl'):
+        return path
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    return path + '.jsonl'
+
+
+class ResultWriter:
+
+    def __init__(self, path, mode='w', fsync_every=20):
+        self.path = jsonl_path(path)
+        self.fsync_every = fsync_every
+        if mode == 'a':
+            _drop_partial_line(self.path)
+        self.file = open(self.path, mode, encoding='utf-8')
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def write(self, obj):
+        line = json.dumps(obj) + '\n'
+        with self._lock:
+            # flush every record so a crash loses at most the line being written,
+            # but only pay for fsync once per batch
+            self.file.write(line)
+            self.file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                os.fsync(self.file.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _drop_partial_line(path):
+    # appending after a truncated record would corrupt the next one too, so cut the file back to its last full line
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def iter_results(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # a run killed mid-write leaves a truncated last line behind
+                print(f"Skipping truncated record in {path}")
+
+
+def read_results(path):
+    # Accepts the path of either format; a .jsonl written next to a .json path takes precedence.
+    if os.path.exists(jsonl_path(path)):
+        return list(iter_results(jsonl_path(path)))
+    with open(path) as f:
+        return json.load(f)
+
+
+def add_result_args(parser):
+    parser.add_argument("--resume", action="store_true", help="skip items already in the output file and append the rest")
+    return parser
+
+
+def open_results(path, resume=False):
+    # Returns the writer for a stage's output and the ids of the items it already holds.
+    # Every record stores its dataset index as "id", so a restarted run continues with the first missing item.
+    completed = set()
+    if resume and os.path.exists(jsonl_path(path)):
+        completed = set(obj['id'] for obj in iter_results(jsonl_path(path)) if 'id' in obj)
+        print(f"Resuming: {len(completed)} items already completed in {jsonl_path(path)}")
+    writer = ResultWriter(path, mode='a' if resume else 'w')
+    return writer, completed
+
+
+def jsonl_to_json(path, json_file=None):
+    if json_file is None:
+        json_file = jsonl_path(path)[:-len('.jsonl')] + '.json'
+    out_objs = list(iter_results(jsonl_path(path)))
+    json.dump(out_objs, open(json_file, "w"), indent=4)
+    return json_file
+
+
+if __name__ == '__main__':
+    # python -m code.result_io <result.jsonl> [...] converts results back to the JSON-array format
+    for result_file in sys.argv[1:]:
+        print(jsonl_to_json(result_file))
@@ -0,0 +1,26 @@
+import pytest
+from .. import utils
+
+
+class ScriptedBackend:
+    # answers every call with the next scripted response and counts the calls
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def invoke(self, messages, max_token, use_temp, top_p, modelId):
+        response = self.responses[min(self.calls, len(self.responses) - 1)]
+        self.calls += 1
+        return response
+
+
+@pytest.fixture
+def backend():
+    def install(responses):
+        backend = ScriptedBackend(responses)
+        utils.set_backend(backend)
+        return backend
+    utils.set_response_cache(None)
+    yield install
+    utils.set_backend(None)
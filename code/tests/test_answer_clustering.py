@@ -0,0 +1,73 @@
+import numpy as np
+from ..answer_clustering import precluster, keep_apart, cluster_locally
+
+
+class FixedSimilarity:
+    # embedding service stand-in with a given similarity matrix
+
+    def __init__(self, similarity):
+        self.similarity = np.array(similarity, dtype=float)
+
+    def similarity_matrix(self, texts):
+        return self.similarity
+
+
+ANSWERS = ["Paris", "Paris, France", "The city of Paris", "Lyon", "Marseille"]
+# 1 and 2 clearly the same, 3 ambiguous with both, 4 and 5 clearly different from everything
+SIMILARITY = [
+    [1.0, 0.95, 0.7, 0.2, 0.1],
+    [0.95, 1.0, 0.7, 0.2, 0.1],
+    [0.7, 0.7, 1.0, 0.3, 0.2],
+    [0.2, 0.2, 0.3, 1.0, 0.4],
+    [0.1, 0.1, 0.2, 0.4, 1.0],
+]
+
+
+def test_precluster_merges_clear_pairs_and_flags_ambiguous_ones():
+    clusters, ambiguous = precluster(ANSWERS, FixedSimilarity(SIMILARITY), high=0.9, low=0.5)
+    assert dict(clusters) == {"Paris": [1, 2], "The city of Paris": [3], "Lyon": [4], "Marseille": [5]}
+    assert ambiguous
+
+
+def test_keep_apart_accepts_merges_of_ambiguous_pairs():
+    service = FixedSimilarity(SIMILARITY)
+    clusters, _ = precluster(ANSWERS, service, high=0.9, low=0.5)
+    groups = {"Paris": [1, 2, 3], "Lyon": [4], "Marseille": [5]}
+    assert dict(keep_apart(groups, clusters, ANSWERS, service, low=0.5)) == groups
+
+
+def test_keep_apart_splits_merges_of_clearly_different_answers():
+    service = FixedSimilarity(SIMILARITY)
+    clusters, _ = precluster(ANSWERS, service, high=0.9, low=0.5)
+    # the model joins everything and leaves agent 5 out
+    groups = {"France": [1, 2, 3, 4]}
+    result = keep_apart(groups, clusters, ANSWERS, service, low=0.5)
+    assert dict(result) == {"France": [1, 2, 3], "Lyon": [4], "Marseille": [5]}
+
+
+def test_keep_apart_keeps_pre_clusters_whole():
+    service = FixedSimilarity(SIMILARITY)
+    clusters, _ = precluster(ANSWERS, service, high=0.9, low=0.5)
+    # the model splits agents 1 and 2, which the embeddings had merged
+    groups = {"Paris": [1, 3], "Paris, France": [2], "Lyon": [4], "Marseille": [5]}
+    result = keep_apart(groups, clusters, ANSWERS, service, low=0.5)
+    assert dict(result) == {"Paris": [1, 2, 3], "Lyon": [4], "Marseille": [5]}
+
+
+def test_cluster_locally_settles_identical_answers():
+    clusters, settled = cluster_locally(["Paris.", "paris", "The answer is Paris"], dedup=True)
+    assert settled and dict(clusters) == {"Paris.": [1, 2, 3]}
+
+
+def test_cluster_locally_leaves_collapsed_answers_to_the_model():
+    clusters, settled = cluster_locally(["Paris.", "paris", "Lyon"], dedup=True)
+    assert not settled and dict(clusters) == {"Paris.": [1, 2], "Lyon": [3]}
+    assert cluster_locally(["Paris", "Lyon", "Rome"], dedup=True) == (None, False)
+    assert cluster_locally(["Paris", "Paris"]) == (None, False)
+
+
+def test_cluster_locally_preclusters_with_embeddings():
+    clusters, settled = cluster_locally(ANSWERS, embedding_service=FixedSimilarity(SIMILARITY), high=0.9, low=0.5)
+    assert not settled and dict(clusters) == {"Paris": [1, 2], "The city of Paris": [3], "Lyon": [4], "Marseille": [5]}
+    clusters, settled = cluster_locally(ANSWERS, embedding_service=FixedSimilarity(SIMILARITY), high=0.9, low=0.75)
+    assert settled
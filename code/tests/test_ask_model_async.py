@@ -0,0 +1,80 @@
+import json
+import time
+import asyncio
+import pytest
+from .. import utils
+from ..benchmarks.stub_server import StubServer
+
+
+LATENCY = 0.2
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "What is the capital of France?"},
+    {"role": "assistant", "content": "Paris."},
+    {"role": "user", "content": "And of Italy?"},
+]
+MODELS = ["meta.llama3-70b-instruct-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    # the stub does not check signatures, but botocore needs credentials to sign with
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'stub')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'stub')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    requests = []
+
+    def responder(modelId, request_body):
+        requests.append((modelId, request_body))
+        return "Rome."
+
+    server = StubServer(latency=LATENCY, responder=responder).start()
+    server.requests = requests
+    monkeypatch.setitem(utils.client_config, 'endpoint_url', server.url)
+    max_concurrency = utils.async_config['max_concurrency']
+    utils.reset_clients()
+    utils.set_backend(None)
+    utils.set_response_cache(None)
+    yield server
+    utils.set_async_concurrency(max_concurrency)
+    utils.reset_clients()
+    server.stop()
+
+
+def gather(num_calls, modelId=MODELS[0]):
+    async def run_all():
+        return await asyncio.gather(*[utils.ask_model_async(MESSAGES, use_temp=0.7, modelId=modelId)
+                                      for _ in range(num_calls)])
+    return asyncio.run(run_all())
+
+
+def test_gathered_calls_overlap(stub):
+    utils.set_async_concurrency(8)
+    start = time.perf_counter()
+    responses = gather(8)
+    elapsed = time.perf_counter() - start
+    assert responses == ["Rome."] * 8
+    assert elapsed < 8 * LATENCY / 2
+
+
+def test_in_flight_requests_are_capped(stub):
+    utils.set_async_concurrency(3)
+    responses = gather(9)
+    assert responses == ["Rome."] * 9
+    assert stub.num_requests == 9
+    assert 1 < stub.max_in_flight <= 3
+
+
+@pytest.mark.parametrize("modelId", MODELS)
+def test_same_request_as_ask_model(stub, modelId):
+    response = utils.ask_model(MESSAGES, use_temp=0.7, modelId=modelId)
+    assert gather(1, modelId) == [response]
+    (sync_model, sync_body), (async_model, async_body) = stub.requests
+    assert sync_model == async_model == modelId
+    assert sync_body == async_body == json.loads(utils.build_request_body(MESSAGES, 256, 0.7, 1, modelId))
+    if 'llama' in modelId:
+        assert async_body["prompt"].startswith("<|begin_of_text|><|start_header_id|>system<|end_header_id|>")
+        assert async_body["prompt"].endswith("And of Italy?<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n")
+    else:
+        assert async_body["system"] == "You are a helpful assistant."
+        assert [turn["role"] for turn in async_body["messages"]] == ["user", "assistant", "user"]
@@ -0,0 +1,30 @@
+import sys
+from ..agent_interaction import pipeline_agent_interaction
+
+
+ANSWERS = ["Paris.", "paris", "Lyon", "Lyon", "The answer is Marseille."]
+
+
+def make_pipeline(monkeypatch, *flags):
+    monkeypatch.setattr(sys, 'argv', ['pipeline_agent_interaction', '--model_name', 'meta.llama3'] + list(flags))
+    return pipeline_agent_interaction.Pipeline(pipeline_agent_interaction.parse_args())
+
+
+def test_exhausted_budget_keeps_the_dedup_groups(backend, monkeypatch):
+    pipe = make_pipeline(monkeypatch, '--dedup_answers', '--max_calls_per_question', '1')
+    pipe.budget.charge(100, 100)
+    fake = backend(['{"Paris": [1, 2, 3, 4, 5]}'])
+
+    clusters = pipe.check_answer_consistency("What is the capital of France?", ANSWERS)
+    assert fake.calls == 0
+    assert sorted(clusters.values()) == [[1, 2], [3, 4], [5]]
+    assert pipe.budget.hit
+
+
+def test_dedup_groups_are_compared_while_the_budget_lasts(backend, monkeypatch):
+    pipe = make_pipeline(monkeypatch, '--dedup_answers', '--max_calls_per_question', '5')
+    fake = backend(['{"Paris": [1, 2], "Lyon": [3, 4], "Marseille": [5]}'])
+
+    clusters = pipe.check_answer_consistency("What is the capital of France?", ANSWERS)
+    assert fake.calls == 1
+    assert sorted(clusters.values()) == [[1, 2], [3, 4], [5]]
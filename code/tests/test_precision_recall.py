@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+pytest.importorskip("sklearn")
+from ..evaluation.draw_figure import compute_precision_recall, compute_precision_recall_loop
+
+
+def assert_same_curve(scores, evaluations, unknown_labels, thresholds):
+    precisions, recalls = compute_precision_recall(scores, evaluations, unknown_labels, thresholds)
+    loop_precisions, loop_recalls = compute_precision_recall_loop(scores, evaluations, unknown_labels, thresholds)
+    assert len(precisions) == len(loop_precisions)
+    np.testing.assert_allclose(precisions, loop_precisions)
+    np.testing.assert_allclose(recalls, loop_recalls)
+
+
+def random_case(rng):
+    n = int(rng.integers(1, 60))
+    # few distinct scores, so ties are common
+    scores = np.round(rng.random(n) * 2, int(rng.integers(0, 3)))
+    evaluations = rng.integers(0, 2, n)
+    unknown_labels = rng.random(n) < rng.random()
+    return scores, evaluations, unknown_labels
+
+
+def test_matches_loop_on_random_cases():
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        scores, evaluations, unknown_labels = random_case(rng)
+        thresholds = np.concatenate([[-1.0, 3.0], rng.random(int(rng.integers(0, 20))) * 2, scores[:5]])
+        assert_same_curve(scores, evaluations, unknown_labels, thresholds)
+        # default thresholds: one per distinct score of an answered query
+        unique_thresholds = np.unique(scores[~unknown_labels])
+        precisions, recalls = compute_precision_recall(scores, evaluations, unknown_labels)
+        loop_precisions, loop_recalls = compute_precision_recall_loop(scores, evaluations, unknown_labels, unique_thresholds)
+        np.testing.assert_allclose(precisions, loop_precisions)
+        np.testing.assert_allclose(recalls, loop_recalls)
+
+
+def test_empty_input():
+    empty = np.array([])
+    assert_same_curve(empty, empty, np.array([], dtype=bool), np.array([0.0, 0.5]))
+    precisions, recalls = compute_precision_recall(empty, empty, np.array([], dtype=bool))
+    assert len(precisions) == 0 and len(recalls) == 0
+
+
+def test_all_queries_unknown():
+    scores = np.array([0.0, 0.3, 0.3, 1.2])
+    evaluations = np.array([1, 0, 1, 1])
+    unknown_labels = np.ones(4, dtype=bool)
+    assert_same_curve(scores, evaluations, unknown_labels, np.array([-1.0, 0.0, 0.3, 2.0]))
+    precisions, recalls = compute_precision_recall(scores, evaluations, unknown_labels)
+    assert len(precisions) == 0 and len(recalls) == 0
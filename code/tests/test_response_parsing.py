@@ -0,0 +1,30 @@
+import pytest
+from ..response_parsing import parse_clusters
+from ..benchmarks.bench_json_parsing import CORPUS, legacy_parse, normalize, replay
+
+
+USABLE = [entry for entry in CORPUS if entry["expected"] is not None]
+
+
+@pytest.mark.parametrize("entry", USABLE, ids=range(len(USABLE)))
+def test_logged_responses_are_recovered(entry):
+    assert {key: value for key, value in normalize(parse_clusters(entry["response"])).items() if value} == entry["expected"]
+
+
+@pytest.mark.parametrize("response", [entry["response"] for entry in CORPUS if entry["expected"] is None] + [
+    "",
+    "Paris: 1, 2",
+    "[1, 2, 3]",
+    '{"Paris.": "none"}',
+])
+def test_responses_without_a_mapping_are_rejected(response):
+    # these still cost a regeneration call
+    with pytest.raises(ValueError):
+        parse_clusters(response)
+
+
+def test_avoided_retries():
+    legacy = [replay(legacy_parse, entry) for entry in CORPUS]
+    tolerant = [replay(parse_clusters, entry) for entry in CORPUS]
+    assert tolerant.count("wrong") == 0
+    assert sum(old != "ok" and new == "ok" for old, new in zip(legacy, tolerant)) == 11
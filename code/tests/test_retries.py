@@ -0,0 +1,50 @@
+import sys
+import pytest
+from .. import utils
+from ..response_parsing import parse_guess
+from ..agent_interaction import pipeline_agent_interaction
+
+
+MESSAGES = [{"role": "user", "content": "Question: q\nGold answer: a\nGenerated answer: a"}]
+GUESS = "Guess: Yes\nProbability: 0.9"
+MALFORMED = "Yes, the generated answer is correct."
+
+
+def test_parsed_first_response_makes_one_call(backend):
+    fake = backend([GUESS])
+    result = utils.ask_with_retries(MESSAGES, parse_guess, 5, use_temp=0.15, modelId='meta.llama3')
+    assert result.ok and result.value == "Yes"
+    assert result.attempts == 1
+    assert fake.calls == 1
+
+
+@pytest.mark.parametrize("num_calls", [2, 3, 5])
+def test_malformed_responses_are_retried(backend, num_calls):
+    fake = backend([MALFORMED] * (num_calls - 1) + [GUESS])
+    result = utils.ask_with_retries(MESSAGES, parse_guess, 5, use_temp=0.15, modelId='meta.llama3')
+    assert result.ok and result.value == "Yes"
+    assert result.attempts == num_calls
+    assert fake.calls == num_calls
+
+
+def test_gives_up_after_max_retries(backend):
+    fake = backend([MALFORMED])
+    result = utils.ask_with_retries(MESSAGES, parse_guess, 3, use_temp=0.15, modelId='meta.llama3')
+    assert not result.ok and result.value is None
+    assert result.attempts == 3
+    assert fake.calls == 3
+
+
+def test_check_answer_semantic_stops_after_parsed_guess(backend, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['pipeline_agent_interaction', '--model_name', 'meta.llama3'])
+    pipe = pipeline_agent_interaction.Pipeline(pipeline_agent_interaction.parse_args())
+
+    fake = backend([GUESS])
+    guess, response = pipe.check_answer_semantic("q", "Paris", "Paris")
+    assert (guess, response) == ("Yes", GUESS)
+    assert fake.calls == 1
+
+    fake = backend([MALFORMED, MALFORMED, GUESS])
+    guess, response = pipe.check_answer_semantic("q", "Paris", "Paris")
+    assert guess == "Yes"
+    assert fake.calls == 3
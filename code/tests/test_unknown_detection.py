@@ -0,0 +1,36 @@
+import pytest
+from ..unknown_detection import detect_unknown
+
+
+@pytest.mark.parametrize("answer", [
+    "I don't know.",
+    "The response does not provide enough information to determine the answer.",
+    "Unfortunately, I do not have enough information about this person.",
+    "The exact date is uncertain.",
+    "Unknown.",
+    "",
+])
+def test_listed_phrases_are_unknown(answer):
+    assert detect_unknown(answer) == "I don't know"
+
+
+@pytest.mark.parametrize("answer", [
+    # similar expressions, which the prompt also maps to "I don't know"
+    "No one knows for sure.",
+    "It is impossible to say.",
+    "Nothing is known about it.",
+    "There is no consensus on this.",
+    "He isn't sure.",
+    # phrases inside names and terms
+    "The Unknown Soldier is buried at Arlington.",
+    "Uncertainty principle was formulated by Heisenberg.",
+    # long answers
+    "Paris is the capital of France and has been since the tenth century.",
+])
+def test_anything_else_but_short_plain_answers_goes_to_the_model(answer):
+    assert detect_unknown(answer) is None
+
+
+@pytest.mark.parametrize("answer", ["Paris.", "Marie Curie", "The Pacific Ocean.", "1969"])
+def test_short_plain_answers_are_kept(answer):
+    assert detect_unknown(answer) == answer
@@ -0,0 +1,162 @@
+import re
+import threading
+from .utils import ask_model
+from .prompt_prefix import PromptPrefix
+
+
+# The uncertainty phrases listed in the check_unknown prompt. An answer containing one of them is
+# "I don't know" by the prompt's own rule, so there is no need to ask the model.
+UNCERTAINTY_PHRASES = [
+    "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
+    "is not definitively known", "is uncertain", "does not mention", "there is no information",
+    "does not provide", "there is not enough information provided to determine", "cannot be determined",
+    "is not provided", "is not known", "The response does not provide any information",
+    "The response does not provide enough information", "There is no answer.", "is unclear",
+    "remains uncertain",
+    "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
+    "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
+    "there is no definitive",
+    "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
+    "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
+    "you do not have enough verified information",
+    "I don't have enough information", "I need more context", "I apologize, ",
+    "The question cannot be answered", "no factual information", "not enough factual information",
+    "does not have enough factual information", "does not actually have any factual information", "Unknown",
+    "couldn't find any information", "There is no information available", "There is no information",
+    "There is not enough information", "I need more information to"
+]
+
+# Single words of the list above that also occur in names and terms ("The Unknown Soldier", "Uncertainty
+# principle"); an answer is decided locally on them only when it is nothing but the word ("Unknown.").
+AMBIGUOUS_PHRASES = ["unknown", "uncertain"]
+
+# Wording that only resembles the phrases above ("or similar expressions" in the prompt), negations and hedges.
+# A short answer without any of these is returned unchanged; every other answer is left to the model.
+SIMILAR_EXPRESSIONS = [
+    "not sure", "unsure", "unclear", "no information", "not enough", "insufficient", "cannot", "can't",
+    "unable to", "sorry", "apologize", "no evidence", "not possible to", "no record", "not aware",
+    "not available", "not specified", "not mentioned", "no answer", "hard to say", "difficult to determine",
+    "depends on", "not certain", "no definitive", "unanswerable", "not clear",
+    "no", "not", "none", "nothing", "nobody", "no one", "never", "neither", "nor", "impossible", "unknowable",
+    "may", "might", "maybe", "perhaps", "possibly", "probably", "likely", "unlikely", "doubt", "debated",
+    "disputed", "consensus", "know", "knows", "known", "say", "unknown", "uncertain", "uncertainty",
+]
+
+# answers up to this many words can be returned unchanged without the model
+MAX_KNOWN_WORDS = 8
+
+
+def _compile(phrases):
+    # one alternation, longest phrase first, so each answer is scanned once; a phrase that starts or ends
+    # with a letter only matches there on a word boundary, so "uncertain" does not match "uncertainty"
+    phrases = sorted(set(phrase.lower() for phrase in phrases), key=len, reverse=True)
+    alternatives = []
+    for phrase in phrases:
+        pattern = re.escape(phrase)
+        if phrase[0].isalnum():
+            pattern = r'\b' + pattern
+        if phrase[-1].isalnum():
+            pattern = pattern + r'\b'
+        alternatives.append(pattern)
+    return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+
+uncertainty_pattern = _compile([phrase for phrase in UNCERTAINTY_PHRASES if phrase.lower() not in AMBIGUOUS_PHRASES])
+ambiguous_pattern = re.compile(r'\W*(' + '|'.join(AMBIGUOUS_PHRASES) + r')\W*', re.IGNORECASE)
+similar_pattern = _compile(SIMILAR_EXPRESSIONS)
+# "isn't", "doesn't", ...
+contraction_pattern = re.compile(r"n['’]t\b", re.IGNORECASE)
+
+_stats = {"local_unknown": 0, "local_known": 0, "model": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def detect_unknown(answer):
+    # Returns "I don't know", the unchanged answer, or None when only the model can decide.
+    if answer.strip() == '' or uncertainty_pattern.search(answer) or ambiguous_pattern.fullmatch(answer):
+        _count("local_unknown")
+        return "I don't know"
+    if (len(answer.split()) > MAX_KNOWN_WORDS or similar_pattern.search(answer)
+            or contraction_pattern.search(answer)):
+        _count("model")
+        return None
+    _count("local_known")
+    return answer
+
+
+# few-shot prefix of check_unknown
+unknown_prompt = PromptPrefix([
+    {
+        "role": "system",
+        "content": """Evaluate the model's response to determine if it indicates uncertainty. Use the following steps:
+                1. Check if the response contains any phrases from a predefined list of "uncertainty phrases" or similar expressions. These phrases indicate that the model does not know the answer.
+                2. If any uncertainty phrase or similar expressions is present, return "I don't know".
+                3. If no uncertainty phrase is present, return the original response exactly as is, without any changes or added explanation.
+
+                Uncertainty phrases include:
+                [
+                    "unknown", "don't know", "do not know", "I don't know", "cannot be determined with certainty",
+                    "is not definitively known", "is uncertain", "does not mention", "there is no information",
+                    "does not provide", "there is not enough information provided to determine", "cannot be determined",
+                    "is not provided", "is not known", "The response does not provide any information",
+                    "The response does not provide enough information", "There is no answer.", "is unclear",
+                    "remains uncertain",
+                    "Unfortunately, I don't have enough", "Unfortunately, I do not have enough", "Unfortunately, ",
+                    "I'm afraid I ", "There is no definitive", "I apologize, but I do not feel comfortable",
+                    "there is no definitive",
+                    "I do not have enough factual information", "I don't have enough context", "I apologize, but I couldn't",
+                    "I do not have enough information", "not explicitly stated", "uncertain", "there is not enough information",
+                    "you do not have enough verified information",
+                    "I don't have enough information", "I need more context", "I apologize, ",
+                    "The question cannot be answered", "no factual information", "not enough factual information",
+                    "does not have enough factual information", "does not actually have any factual information", "Unknown", 
+                    "couldn't find any information", "There is no information available", "There is no information",
+                    "There is not enough information", "I need more information to"
+                ]"""
+    },
+    {
+        "role": "user",
+        "content": "The response does not provide enough information to determine the answer.",
+    },
+    {
+        "role": "assistant",
+        "content": "I don't know"
+    },
+    {
+        "role": "user",
+        "content": "It takes repeated uses over a short space of time to become physically addicted to heroin.",
+    },
+    {
+        "role": "assistant",
+        "content": "It takes repeated uses over a short space of time to become physically addicted to heroin."
+    },
+])
+
+
+def check_unknown(answer, modelId):
+    # "I don't know" if the answer says it does not know, otherwise the answer itself
+    predict_answer = detect_unknown(answer)
+    if predict_answer is not None:
+        return predict_answer
+
+    # if we have a new model, use this prompt, otherwise for claude3 and llama3, the uncertainty phrases are more accuate.
+
+    message = unknown_prompt.copy()
+
+    message.append({"role": "user", "content": answer})
+    response = ask_model(message, use_temp=0.15, modelId=modelId)
+    return response
+
+
+def unknown_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = sum(stats.values())
+    stats["model_calls_saved"] = stats["local_unknown"] + stats["local_known"]
+    stats["saved_rate"] = stats["model_calls_saved"] / total if total else 0.0
+    return stats
@@ -1,19 +1,249 @@
-import boto3
+import os
+import sys
+import json
 import time
+import atexit
+import asyncio
+import weakref
+import threading
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from .llm_cache import ResponseCache, cache_key
+from .llm_metrics import metrics, with_context, count_tokens
+
+
+# Settings for the Bedrock runtime clients, overridable from the command line via configure_model(args).
+client_config = {
+    "region_name": os.environ.get("AWS_REGION"),
+    "endpoint_url": os.environ.get("BEDROCK_ENDPOINT_URL"),
+    "max_pool_connections": 50,
+    "connect_timeout": 10,
+    "read_timeout": 300,
+    "max_attempts": 8,
+}
+
+# Process-wide cap on concurrent Bedrock requests across all threads (0 means unlimited).
+_in_flight = None
+
+# Response cache consulted by ask_model. Calls at or below cache_temperature are deterministic enough to be
+# cached by default; sampled calls are only cached with cache_sampled, or when a caller passes cache=True.
+# A retry passes its attempt number, so it reads and writes its own entry instead of getting back the response
+# that was just rejected; callers with a parser pass it as validate, so rejected responses are never stored.
+cache_config = {
+    "cache_temperature": 0.15,
+    "cache_sampled": False,
+}
+_response_cache = None
+_sample_counts = dict()
+_sample_counts_lock = threading.Lock()
+
+# Upper bound on the number of ask_model_async requests in flight per event loop.
+async_config = {
+    "max_concurrency": 16,
+}
+
+# Request options. prompt_caching marks the end of a shared PromptPrefix as a Claude prompt cache breakpoint,
+# so Bedrock can reuse the processed few-shot prefix across calls instead of reading it again.
+request_config = {
+    "prompt_caching": False,
+}
+
+# Backend answering ask_model in place of Bedrock, e.g. a MockBackend for offline runs (None means Bedrock).
+_backend = None
+
+# One long-lived client per (model, region). boto3 clients are thread-safe, so every thread shares them
+# and reuses the same keep-alive connection pool instead of re-resolving credentials and endpoints per call.
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def _create_client(region_name):
+    config = Config(
+        region_name=region_name,
+        max_pool_connections=client_config['max_pool_connections'],
+        connect_timeout=client_config['connect_timeout'],
+        read_timeout=client_config['read_timeout'],
+        tcp_keepalive=True,
+        retries={"max_attempts": client_config['max_attempts'], "mode": "adaptive"},
+    )
+    # a dedicated session, since the default boto3 session is not thread-safe
+    session = boto3.session.Session()
+    return session.client(service_name='bedrock-runtime', endpoint_url=client_config['endpoint_url'], config=config)
+
+
+def get_client(modelId, region_name=None):
+    region_name = region_name or client_config['region_name']
+    key = (modelId, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _create_client(region_name)
+                _clients[key] = client
+    return client
+
+
+def reset_clients():
+    with _clients_lock:
+        _clients.clear()
+
+
+def add_model_args(parser):
+    parser.add_argument("--region", type=str, default=None, help="AWS region of the Bedrock endpoint")
+    parser.add_argument("--endpoint_url", type=str, default=None, help="override the Bedrock endpoint url")
+    parser.add_argument("--max_pool_connections", type=int, default=50, help="keep-alive connections per client")
+    parser.add_argument("--async_concurrency", type=int, default=16, help="max concurrent ask_model_async requests")
+    parser.add_argument("--max_in_flight", type=int, default=0, help="max concurrent model requests per process, 0 for no limit")
+    parser.add_argument("--cache_path", type=str, default=None, help="SQLite file caching model responses")
+    parser.add_argument("--cache_max_entries", type=int, default=1000000, help="max cached responses before LRU eviction")
+    parser.add_argument("--cache_read_only", action="store_true", help="serve cached responses but never store new ones")
+    parser.add_argument("--cache_sampled", action="store_true", help="also cache sampled (high temperature) calls")
+    parser.add_argument("--prompt_caching", action="store_true", help="mark shared few-shot prompt prefixes for Claude prompt caching")
+    parser.add_argument("--backend", type=str, default="bedrock", choices=["bedrock", "mock"], help="model backend; mock answers locally without Bedrock")
+    parser.add_argument("--mock_seed", type=int, default=0, help="seed of the mock backend")
+    parser.add_argument("--mock_latency", type=float, default=0.0, help="simulated seconds per mock call")
+    parser.add_argument("--mock_token_latency", type=float, default=0.0, help="simulated seconds per output token of a mock call")
+    parser.add_argument("--mock_failure_rate", type=float, default=0.0, help="fraction of malformed mock responses for prompts the pipelines retry")
+    parser.add_argument("--metrics", action="store_true", help="record every model call and print a per call-site summary at exit")
+    parser.add_argument("--trace_path", type=str, default=None, help="write the recorded calls as a Chrome trace (implies --metrics)")
+    return parser
+
+
+def configure_model(args):
+    if args.region is not None:
+        client_config['region_name'] = args.region
+    if args.endpoint_url is not None:
+        client_config['endpoint_url'] = args.endpoint_url
+    client_config['max_pool_connections'] = args.max_pool_connections
+    reset_clients()
+    set_async_concurrency(args.async_concurrency)
+    set_max_in_flight(args.max_in_flight)
+    cache_config['cache_sampled'] = args.cache_sampled
+    request_config['prompt_caching'] = args.prompt_caching
+    if args.cache_path is not None:
+        set_response_cache(ResponseCache(args.cache_path, max_entries=args.cache_max_entries, read_only=args.cache_read_only))
+    if args.backend == "mock":
+        # imported here: the mock backend uses unknown_detection, which itself calls ask_model
+        from .mock_backend import MockBackend
+        set_backend(MockBackend(seed=args.mock_seed, latency=args.mock_latency, token_latency=args.mock_token_latency,
+                                failure_rate=args.mock_failure_rate))
+    else:
+        set_backend(None)
+    if args.metrics or args.trace_path is not None:
+        enable_metrics(args.trace_path)
+
+
+def enable_metrics(trace_path=None):
+    if not metrics.enabled:
+        atexit.register(_report_metrics, trace_path)
+    metrics.enabled = True
+
+
+def _report_metrics(trace_path):
+    print('Model calls per call site:')
+    print(metrics.format_summary())
+    if trace_path is not None:
+        print('Call trace: ', metrics.export_chrome_trace(trace_path))
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def set_response_cache(response_cache):
+    global _response_cache
+    if _response_cache is None and response_cache is not None:
+        atexit.register(_report_cache)
+    _response_cache = response_cache
+
+
+def cache_stats():
+    if _response_cache is None:
+        return None
+    return _response_cache.stats()
+
+
+def _report_cache():
+    if _response_cache is not None:
+        print('Response cache: ', _response_cache.stats())
+
+
+def _request_key(messages, max_token, use_temp, top_p, modelId, attempt=0):
+    key = cache_key(messages, modelId, use_temp, top_p, max_token)
+    if attempt > 0:
+        # the n-th retry of a request, which a rerun replays in the same order
+        key = key + '-retry' + str(attempt)
+    if use_temp > cache_config['cache_temperature']:
+        # number repeated sampled requests, so e.g. five self-consistency samples map to five entries
+        # that a rerun replays in the same order, instead of one response returned five times
+        with _sample_counts_lock:
+            count = _sample_counts.get(key, 0)
+            _sample_counts[key] = count + 1
+        key = key + '-' + str(count)
+    return key
+
+
+def set_max_in_flight(max_in_flight):
+    global _in_flight
+    _in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+
+
+def llama_prompt(messages):
+    # the header-tagged Llama 3 prompt of messages, without the trailing assistant header
+    prompt = ""
+    for message in messages:
+        if message["role"] == "system":
+            prompt += "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
+        elif message["role"] == "user":
+            prompt += "<|start_header_id|>user<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
+        elif message["role"] == "assistant":
+            prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
+    return prompt
+
+
+def claude_messages(messages):
+    # the system prompt ('' if none) and the Messages API turns of messages
+    prompt_messages = []
+    system_message = ''
+    for message in messages:
+        if message["role"] == "system":
+            system_message = message["content"]
+        elif message["role"] == "user":
+            prompt_messages.append({
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": message["content"]
+                    }]})
+        elif message["role"] == "assistant":
+            prompt_messages.append({
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": message["content"]
+                    }]})
+    return system_message, prompt_messages
+
 
-def ask_model(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3-70b-instruct-v1:0'):
+def build_request_body(messages, max_token, use_temp, top_p, modelId):
 
-    brt = boto3.client(service_name='bedrock-runtime')
+    # messages built from a PromptPrefix carry the prefix's serialization, so only the rest is serialized here
+    prefix = getattr(messages, 'prefix', None)
+    if prefix is not None and not prefix.matches(messages):
+        prefix = None
 
     if 'llama' in modelId:
-        prompt = ""
-        for message in messages:
-            if message["role"] == "system":
-                prompt += "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
-            elif message["role"] == "user":
-                prompt += "<|start_header_id|>user<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
-            elif message["role"] == "assistant":
-                prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n{}<|eot_id|>".format(message["content"])
+        if prefix is None:
+            prompt = llama_prompt(messages)
+        else:
+            prompt = prefix.llama_prompt + llama_prompt(messages[len(prefix):])
         prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
 
         body = json.dumps({
@@ -24,27 +254,12 @@ def ask_model(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3
         })
     elif 'claude' in modelId:
 
-        prompt_messages = []
-        system_message = ''
-        for message in messages:
-            if message["role"] == "system":
-                system_message = message["content"]
-            elif message["role"] == "user":
-                prompt_messages.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": message["content"]
-                        }]})
-            elif message["role"] == "assistant":
-                prompt_messages.append({
-                    "role": "assistant",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": message["content"]
-                        }]})
+        if prefix is None:
+            system_message, prompt_messages = claude_messages(messages)
+        else:
+            system_message, prompt_messages = claude_messages(messages[len(prefix):])
+            prompt_messages = prefix.claude_messages(request_config['prompt_caching']) + prompt_messages
+            system_message = system_message or prefix.claude_system
         if system_message != '':
             body = json.dumps({
                 "anthropic_version": "bedrock-2023-05-31",
@@ -62,17 +277,158 @@ def ask_model(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3
                 "top_p": top_p,
                 "messages": prompt_messages
             })
+    else:
+        raise ValueError("Unsupported model: " + modelId)
 
-    modelId = modelId  # 'anthropic.claude-v2'
-    accept = 'application/json'
-    contentType = 'application/json'
+    return body
 
-    response = brt.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
-
-    response_body = json.loads(response.get('body').read())
 
+def parse_response_body(response_body, modelId):
     if 'llama' in modelId:
         return response_body.get('generation')
     elif 'claude' in modelId:
         return response_body['content'][0]['text']
 
+
+def parse_usage(response_body, modelId):
+    if 'llama' in modelId:
+        return {"input_tokens": response_body.get('prompt_token_count'),
+                "output_tokens": response_body.get('generation_token_count')}
+    elif 'claude' in modelId:
+        usage = response_body.get('usage', dict())
+        return {"input_tokens": usage.get('input_tokens'), "output_tokens": usage.get('output_tokens')}
+    return dict()
+
+
+def _invoke(messages, max_token, use_temp, top_p, modelId, region_name):
+    # returns the response text and the token usage and retries reported by the backend, if any
+    backend = _backend
+    if backend is not None:
+        return backend.invoke(messages, max_token=max_token, use_temp=use_temp, top_p=top_p, modelId=modelId), None
+
+    brt = get_client(modelId, region_name)
+    body = build_request_body(messages, max_token, use_temp, top_p, modelId)
+
+    accept = 'application/json'
+    contentType = 'application/json'
+
+    response = brt.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
+    response_body = json.loads(response.get('body').read())
+    usage = parse_usage(response_body, modelId)
+    usage['retries'] = response.get('ResponseMetadata', dict()).get('RetryAttempts', 0)
+    return parse_response_body(response_body, modelId), usage
+
+
+def ask_model(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3-70b-instruct-v1:0', region_name=None, cache=None, tag=None, budget=None, attempt=0, validate=None):
+
+    # calls are tagged with the calling function unless the caller names its call site
+    if metrics.enabled and tag is None:
+        tag = sys._getframe(1).f_code.co_name
+    start = time.perf_counter()
+
+    response_cache = _response_cache
+    if cache is None:
+        cache = use_temp <= cache_config['cache_temperature'] or cache_config['cache_sampled']
+    if response_cache is not None and cache:
+        key = _request_key(messages, max_token, use_temp, top_p, modelId, attempt)
+        response = response_cache.get(key)
+        if response is not None:
+            metrics.record(tag, messages, response, start, cache_hit=True)
+            return response
+    else:
+        response_cache = None
+
+    in_flight = _in_flight
+    if in_flight is None:
+        response, usage = _invoke(messages, max_token, use_temp, top_p, modelId, region_name)
+    else:
+        with in_flight:
+            response, usage = _invoke(messages, max_token, use_temp, top_p, modelId, region_name)
+    metrics.record(tag, messages, response, start, usage=usage)
+    if budget is not None:
+        budget.charge(*count_tokens(messages, response, usage))
+
+    if response_cache is not None and _accepts(validate, response):
+        response_cache.put(key, response)
+    return response
+
+
+def _accepts(validate, response):
+    if validate is None:
+        return True
+    try:
+        validate(response)
+        return True
+    except (ValueError, IndexError, KeyError):
+        return False
+
+
+# value: what parse returned (None if no attempt parsed); response: the last response;
+# attempts: model calls made; ok: whether a response parsed
+RetryResult = namedtuple('RetryResult', ['value', 'response', 'attempts', 'ok'])
+
+
+def ask_with_retries(messages, parse, max_retries=5, budget=None, **kwargs):
+    # Asks until parse accepts a response, at most max_retries times. parse raises ValueError (or IndexError/KeyError)
+    # for a malformed response. With a budget, retries stop once it is exhausted.
+    if metrics.enabled and kwargs.get('tag') is None:
+        kwargs['tag'] = sys._getframe(1).f_code.co_name
+    response = None
+    attempts = 0
+    while attempts < max_retries:
+        if attempts > 0 and budget is not None and budget.exhausted():
+            break
+        response = ask_model(messages, budget=budget, attempt=attempts, validate=parse, **kwargs)
+        attempts += 1
+        try:
+            return RetryResult(parse(response), response, attempts, True)
+        except (ValueError, IndexError, KeyError) as e:
+            print(f"Failed to parse the response on attempt {attempts}: {e}")
+    return RetryResult(None, response, attempts, False)
+
+
+_async_semaphores = weakref.WeakKeyDictionary()
+_async_executor = None
+_async_lock = threading.Lock()
+
+
+def set_async_concurrency(max_concurrency):
+    global _async_executor
+    with _async_lock:
+        async_config['max_concurrency'] = max_concurrency
+        _async_semaphores.clear()
+        if _async_executor is not None:
+            _async_executor.shutdown(wait=False)
+            _async_executor = None
+
+
+def _get_async_executor():
+    global _async_executor
+    with _async_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=async_config['max_concurrency'],
+                                                 thread_name_prefix='ask_model_async')
+        return _async_executor
+
+
+def _get_async_semaphore():
+    # asyncio primitives belong to one event loop, so keep a semaphore per running loop
+    loop = asyncio.get_running_loop()
+    semaphore = _async_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(async_config['max_concurrency'])
+        _async_semaphores[loop] = semaphore
+    return semaphore
+
+
+async def ask_model_async(messages, max_token=256, use_temp=1, top_p=1, modelId='meta.llama3-70b-instruct-v1:0', region_name=None, cache=None, tag=None, budget=None, attempt=0, validate=None):
+    # Same request as ask_model, awaited on a bounded pool so callers can gather many independent requests.
+    if metrics.enabled and tag is None:
+        tag = sys._getframe(1).f_code.co_name
+    async with _get_async_semaphore():
+        loop = asyncio.get_running_loop()
+        # run in the caller's context, so the call is attributed to the caller's question and agent
+        call = functools.partial(with_context(ask_model), messages, max_token=max_token, use_temp=use_temp, top_p=top_p,
+                                 modelId=modelId, region_name=region_name, cache=cache, tag=tag,
+                                 budget=budget, attempt=attempt, validate=validate)
+        return await loop.run_in_executor(_get_async_executor(), call)